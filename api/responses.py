@@ -0,0 +1,90 @@
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import HttpResponse, StreamingHttpResponse
+
+from clarify_backend.utils import iterate_in_batches
+
+try:
+    import orjson
+except ImportError:
+    # optional; the standard library encoder is used without it
+    orjson = None
+
+
+COLUMNAR = 'columnar'
+
+STREAM_BATCH_SIZE = 500
+
+
+def dumps(data):
+    """
+    Encode data to JSON bytes, with orjson when it's installed. Dates,
+    times and anything else orjson doesn't know are handed to
+    DjangoJSONEncoder, so both paths produce the same strings (eg.
+    millisecond datetimes, where orjson would give microseconds)
+    """
+    if orjson is not None:
+        return orjson.dumps(
+            data, default=DjangoJSONEncoder().default,
+            option=orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME)
+    return json.dumps(data, cls=DjangoJSONEncoder).encode('utf8')
+
+
+def to_columns(rows, fields):
+    """
+    Pivot dict rows into column lists
+    :param fields: { <column name>: <row key> }
+    """
+    return {
+        column: [row.get(key) for row in rows]
+        for column, key in fields.items()
+    }
+
+
+def to_lookup_table(rows, id_key, fields):
+    """
+    Dictionary-encode the values rows repeat for a related object
+    :param fields: { <field name>: <row key> }
+    :return: { <row[id_key]>: { <field name>: value } }
+    """
+    return {
+        row[id_key]: {field: row.get(key) for field, key in fields.items()}
+        for row in rows if row.get(id_key) is not None
+    }
+
+
+def columnar_response(columns, status=200, **extra):
+    """?format=columnar responses: column lists plus any lookup tables"""
+    payload = {'format': COLUMNAR, 'data': columns}
+    payload.update(extra)
+
+    return HttpResponse(dumps(payload), status=status,
+                        content_type='application/json')
+
+
+def streaming_json_response(rows, status=200, **extra):
+    """
+    {"data": [<rows>], <extra>} written as rows is consumed, so memory
+    stays at one batch of rows however long the iterable is. Encoded
+    like JsonResponse, so clients see the same JSON.
+    """
+
+    def _content():
+        yield b'{"data": ['
+
+        separator = b''
+        for batch in iterate_in_batches(rows, STREAM_BATCH_SIZE):
+            # Strip the list's brackets; batches are joined by commas
+            encoded = json.dumps(batch, cls=DjangoJSONEncoder)[1:-1]
+            yield separator + encoded.encode('utf8')
+            separator = b', '
+
+        yield b']'
+        for key, value in extra.items():
+            yield f", {json.dumps(key)}: " \
+                  f"{json.dumps(value, cls=DjangoJSONEncoder)}".encode('utf8')
+        yield b'}'
+
+    return StreamingHttpResponse(_content(), status=status,
+                                 content_type='application/json')
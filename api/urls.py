@@ -6,7 +6,8 @@ The `urlpatterns` list routes URLs to views. For more information please see:
 from django.conf.urls import url
 from .views import (
     StudentView, SectionView, SessionView,
-    UserView, ActionView, DeltaView, PasswordResetView, LeadView)
+    UserView, ActionView, ActionBatchView, DeltaView, PasswordResetView,
+    LeadView)
 
 from clarify.views import CleverTokenView, GoogleTokenView
 
@@ -19,6 +20,7 @@ urlpatterns = [
     url(r'^delta/$', DeltaView),
     url(r'^delta/student/([0-9]+)/$', DeltaView),
     url(r'^action/$', ActionView),
+    url(r'^action/batch/$', ActionBatchView),
     url(r'^action/([0-9]+)/$', ActionView),
     url(r'^clever-sync/$', CleverTokenView),
     url(r'^google-classroom-sync/$', GoogleTokenView),
@@ -9,21 +9,105 @@ from googleapiclient.discovery import build
 
 from django.shortcuts import get_object_or_404
 from django.http import JsonResponse, HttpResponse
-from django.db.models import Case, When, Value, BooleanField, Q, F
+from django.db import transaction
+from django.db.models import Case, When, Value, BooleanField, Q, F, Max, \
+    Count
 from django.contrib.auth.models import User
 from django.contrib.auth import login, logout, authenticate
 from django.views.decorators.csrf import csrf_exempt
 from django.contrib.auth.decorators import login_required
+from django.contrib.postgres.aggregates import ArrayAgg
+from django.views.decorators.http import condition
 from django.conf import settings
 from sendgrid import sendgrid
 
-from clarify_backend.utils import build_reset_email, word_hash
+from clarify_backend.utils import build_reset_email, word_hash, \
+    encode_cursor, decode_cursor, encode_delta_cursor, decode_delta_cursor, \
+    get_api_cache_generation, api_cache_generation_is_shared, \
+    iterate_in_batches, bulk_update_fields
 from clarify.models import Student, Section, EnrollmentRecord, \
-    StaffSectionRecord, UserProfile, LeadEmail
+    StaffSectionRecord, UserProfile, LeadEmail, TeacherStudentAccess
 from deltas.models import Action, Delta
 from clarify_backend.utils import get_academic_year
 
-from decorators import requires_user_profile, require_methods
+from decorators import requires_user_profile, require_methods, \
+    cache_per_user_profile
+from .responses import COLUMNAR, STREAM_BATCH_SIZE, columnar_response, \
+    streaming_json_response, to_columns, to_lookup_table
+
+PAGE_MAX_LIMIT = 500
+
+# { <column>: <row key> } for ?format=columnar responses; names are
+# those of the default format, related objects' other fields go to
+# lookup tables keyed by their ids
+STUDENT_COLUMNS = {
+    'id': 'id',
+    'first_name': 'first_name',
+    'last_name': 'last_name',
+    'is_enrolled': 'is_enrolled',
+    'enrolled_section_ids': 'enrolled_section_ids',
+}
+
+DELTA_COLUMNS = {
+    'delta_id': 'id',
+    'student_id': 'student_id',
+    'created_on': 'created_on',
+    'updated_on': 'updated_on',
+    'type': 'type',
+    'gradebook_id': 'gradebook_id',
+    'sort_date': 'sort_date',
+    'score_id': 'score_id',
+    'score': 'score__score',
+    'last_updated': 'score__last_updated',
+    'assignment_id': 'score__assignment_id',
+    'category_id': 'context_record__category_id',
+    'context_date': 'context_record__date',
+    'total_points_possible': 'context_record__total_points_possible',
+    'average_points_earned': 'context_record__average_points_earned',
+    'category_average_before': 'category_average_before',
+    'category_average_after': 'category_average_after',
+}
+
+
+def _generation_etag(request, requesting_user_profile, *args, **kwargs):
+    # Roster and delta payloads only change when a sync or delta build
+    # bumps the profile's generation, or (for enrollment windows) the day.
+    # Without a shared cache those bumps can happen out of this process's
+    # sight, so no ETag is offered rather than a 304 on stale data.
+    if not api_cache_generation_is_shared():
+        return None
+
+    return f"{get_api_cache_generation(requesting_user_profile.id)}-" \
+           f"{timezone.now().date().isoformat()}"
+
+
+def _action_etag(request, requesting_user_profile, *args, **kwargs):
+    if request.method != 'GET':
+        return None
+
+    student_ids = TeacherStudentAccess.get_student_ids_for_user_profile(
+        requesting_user_profile.id, current=True)
+
+    actions = (
+        Action.objects
+            .filter(student_id__in=student_ids)
+            .filter(Q(created_by=requesting_user_profile) | Q(is_public=True))
+    )
+
+    # Any write bumps updated_on; the count catches deletes
+    version = actions.aggregate(last_updated=Max('updated_on'),
+                                count=Count('id'))
+    # Deleted deltas take their through rows with them without touching
+    # the action, so the links get a count and max id of their own
+    links = (
+        Action.deltas.through.objects
+            .filter(action_id__in=actions.values('id'))
+            .aggregate(count=Count('id'), max_id=Max('id'))
+    )
+    last_updated = version['last_updated']
+    return f"{requesting_user_profile.id}-{version['count']}-" \
+           f"{last_updated.timestamp() if last_updated else 0}-" \
+           f"{links['count']}-{links['max_id'] or 0}"
 
 
 @login_required(login_url="/")
@@ -61,30 +145,57 @@ def LeadView(request):
 @login_required
 @require_methods("GET")
 @requires_user_profile
+@condition(etag_func=_generation_etag)
+@cache_per_user_profile
 def StudentView(request, requesting_user_profile):
     # TODO: Make this work for an admin account
 
-    def _shape(student, student_section_pairs):
+    response_format = request.GET.get('format', None)
+    if response_format and response_format != COLUMNAR:
+        return JsonResponse(
+            {'error': f'Format must be {COLUMNAR}'},
+            status=400)
+
+    def _shape(student):
         return {
-            'id': student.id,
-            'first_name': student.first_name,
-            'last_name': student.last_name if not settings.ANONYMIZE_STUDENTS else student.last_name[0],
+            'id': student["id"],
+            'first_name': student["first_name"],
+            'last_name': student["last_name"] if not settings.ANONYMIZE_STUDENTS else student["last_name"][0],
             'is_enrolled': True,
-            'enrolled_section_ids': [ssp.section_id for ssp in student_section_pairs if ssp.id == student.id]
+            'enrolled_section_ids': []
         }
 
-    student_section_pairs = requesting_user_profile.get_enrolled_students()
+    student_section_pairs = (
+        requesting_user_profile
+            .get_enrolled_students()
+            .order_by('id', 'section_id')
+            .values('id', 'first_name', 'last_name', 'section_id')
+    )
 
-    unique_students = student_section_pairs.distinct('id')
+    def _students():
+        # Pairs arrive sorted by student, so one pass groups their sections
+        student = None
+        for pair in student_section_pairs.iterator():
+            if student is None or student["id"] != pair["id"]:
+                if student is not None:
+                    yield student
+                student = _shape(pair)
+            student["enrolled_section_ids"].append(pair["section_id"])
 
-    return JsonResponse({
-        'data': [_shape(s, student_section_pairs) for s in unique_students]
-    })
+        if student is not None:
+            yield student
+
+    if response_format == COLUMNAR:
+        return columnar_response(
+            to_columns(list(_students()), STUDENT_COLUMNS))
+
+    return streaming_json_response(_students())
 
 
 @login_required
 @require_methods("GET")
 @requires_user_profile
+@cache_per_user_profile
 def SectionView(request, requesting_user_profile):
     # TODO: make work for admins:
 
@@ -206,118 +317,285 @@ def SessionView(request):
 @login_required
 @require_methods("GET")
 @requires_user_profile
+@condition(etag_func=_generation_etag)
+@cache_per_user_profile
 def DeltaView(request, requesting_user_profile, student_id=None):
     delta_type = request.GET.get('type', None)
 
+    response_format = request.GET.get('format', None)
+    if response_format and response_format != COLUMNAR:
+        return JsonResponse(
+            {'error': f'Format must be {COLUMNAR}'},
+            status=400)
+
+    since = request.GET.get('since', None)
+    if since:
+        try:
+            since = datetime.strptime(since, '%m/%d/%Y').date()
+        except ValueError:
+            return JsonResponse(
+                {'error': 'Since must be in the format mm/dd/yyyy'},
+                status=400)
+
+    cursor = request.GET.get('cursor', None)
+    after = None
+    if cursor:
+        try:
+            after = decode_delta_cursor(cursor)
+        except ValueError:
+            return JsonResponse(
+                {'error': 'Cursor is not valid'},
+                status=400)
+
+    limit = request.GET.get('limit', None)
+    if limit:
+        try:
+            limit = int(limit)
+        except ValueError:
+            limit = 0
+        if not 0 < limit <= PAGE_MAX_LIMIT:
+            return JsonResponse(
+                {'error': f'Limit must be between 1 and {PAGE_MAX_LIMIT}'},
+                status=400)
+
     deltas = Delta.return_response_query(
         requesting_user_profile.id,
         student_id,
-        delta_type
+        delta_type,
+        since=since,
+        after=after
     )
 
-    def _shape_context_record(record):
+    next_cursor = None
+    if limit:
+        # One row past the page tells us whether another page exists
+        deltas = list(deltas[:limit + 1])
+        if len(deltas) > limit:
+            deltas = deltas[:limit]
+            next_cursor = encode_delta_cursor(deltas[-1]["sort_date"],
+                                              deltas[-1]["id"])
+    elif response_format == COLUMNAR:
+        deltas = list(deltas)
+    else:
+        # Streamed below, read from a server-side cursor
+        deltas = deltas.iterator()
+
+    def _shape_context_record(delta):
         return {
-            "category_id": record.category_id,
-            "category_name": record.category.name,
-            "date": record.date,
-            "total_points_possible": record.total_points_possible,
-            "average_points_earned": record.average_points_earned
+            "category_id": delta["context_record__category_id"],
+            "category_name": delta["context_record__category__name"],
+            "date": delta["context_record__date"],
+            "total_points_possible": delta["context_record__total_points_possible"],
+            "average_points_earned": delta["context_record__average_points_earned"]
         }
 
     def _shape_missing_record(record):
         return {
-            "assignment_name": record.assignment.name,
-            "assignment_id": record.assignment_id,
-            "due_date": record.assignment.due_date,
-            "missing_on": record.missing_on
+            "assignment_name": record["assignment__name"],
+            "assignment_id": record["assignment_id"],
+            "due_date": record["assignment__due_date"],
+            "missing_on": record["missing_on"]
         }
 
-    def _shape_delta(delta):
+    def _shape_delta(delta, missing_records):
 
         resp = {
-            "delta_id": delta.id,
-            "student_id": delta.student_id,
-            "created_on": delta.created_on,
-            "updated_on": delta.updated_on,
-            "type": delta.type,
-            "gradebook_name": delta.gradebook.name,
-            "gradebook_id": delta.gradebook_id
+            "delta_id": delta["id"],
+            "student_id": delta["student_id"],
+            "created_on": delta["created_on"],
+            "updated_on": delta["updated_on"],
+            "type": delta["type"],
+            "gradebook_name": delta["gradebook__name"],
+            "gradebook_id": delta["gradebook_id"]
         }
 
-        if delta.type == "missing":
+        if delta["type"] == "missing":
             resp["missing_assignments"] = [
                 _shape_missing_record(a) for a in
-                delta.missingassignmentrecord_set.all()
+                missing_records.get(delta["id"], [])
             ]
-            resp["sort_date"] = delta.created_on
+            resp["sort_date"] = delta["created_on"]
 
-        if delta.type == "category":
+        if delta["type"] == "category":
             score = {
-                "assignment_id": delta.score.assignment_id,
-                "score_id": delta.score.id,
-                "assignment_name": delta.score.assignment.name,
-                "score": delta.score.score,
-                "possible_points": delta.score.assignment.possible_points,
-                "due_date": delta.score.assignment.due_date,
-                "last_updated": delta.score.last_updated
+                "assignment_id": delta["score__assignment_id"],
+                "score_id": delta["score_id"],
+                "assignment_name": delta["score__assignment__name"],
+                "score": delta["score__score"],
+                "possible_points": delta["score__assignment__possible_points"],
+                "due_date": delta["score__assignment__due_date"],
+                "last_updated": delta["score__last_updated"]
             }
             resp["score"] = score
-            resp["context_record"] = _shape_context_record(delta.context_record)
-            resp["category_average_before"] = delta.category_average_before
-            resp["category_average_after"] = delta.category_average_after
-            resp["sort_date"] = delta.score.assignment.due_date
+            resp["context_record"] = _shape_context_record(delta)
+            resp["category_average_before"] = delta["category_average_before"]
+            resp["category_average_after"] = delta["category_average_after"]
+            resp["sort_date"] = delta["score__assignment__due_date"]
 
         return resp
 
-    return JsonResponse({
-        'data': [_shape_delta(d) for d in deltas]
-    })
+    if response_format == COLUMNAR:
+        missing_records = Delta.get_missing_records_for_delta_ids(
+            [d["id"] for d in deltas if d["type"] == Delta.MISSING]
+        )
+        missing_rows = [r for rs in missing_records.values() for r in rs]
+        columns = to_columns(deltas, DELTA_COLUMNS)
+        columns["missing_assignments"] = [
+            [[r["assignment_id"], r["missing_on"]]
+             for r in missing_records.get(d["id"], [])]
+            if d["type"] == Delta.MISSING else None
+            for d in deltas
+        ]
+
+        return columnar_response(
+            columns,
+            gradebooks=to_lookup_table(
+                deltas, "gradebook_id", {"name": "gradebook__name"}),
+            categories=to_lookup_table(
+                deltas, "context_record__category_id",
+                {"name": "context_record__category__name"}),
+            assignments={
+                **to_lookup_table(missing_rows, "assignment_id", {
+                    "name": "assignment__name",
+                    "due_date": "assignment__due_date",
+                    "possible_points": "assignment__possible_points"}),
+                **to_lookup_table(deltas, "score__assignment_id", {
+                    "name": "score__assignment__name",
+                    "due_date": "score__assignment__due_date",
+                    "possible_points": "score__assignment__possible_points"}),
+            },
+            next_cursor=next_cursor
+        )
+
+    def _shaped_deltas():
+        # Missing assignments are looked up a batch of deltas at a time
+        for batch in iterate_in_batches(deltas, STREAM_BATCH_SIZE):
+            missing_records = Delta.get_missing_records_for_delta_ids(
+                [d["id"] for d in batch if d["type"] == Delta.MISSING]
+            )
+            for delta in batch:
+                yield _shape_delta(delta, missing_records)
+
+    return streaming_json_response(_shaped_deltas(), next_cursor=next_cursor)
+
+
+def _shape_action(action: Action):
+    if hasattr(action, 'user_first_name'):
+        user_first_name = action.user_first_name
+        user_last_name = action.user_last_name
+    else:
+        user_first_name = action.created_by.user.first_name
+        user_last_name = action.created_by.user.last_name
+
+    if hasattr(action, 'delta_id_list'):
+        # ArrayAgg over the outer join yields [None] with no deltas
+        delta_ids = sorted(d for d in action.delta_id_list if d)
+    else:
+        delta_ids = [d.id for d in action.deltas.all()]
+
+    return {
+        'id': action.id,
+        'completed_on': action.completed_on,
+        'created_by': {
+            'user_profile_id': action.created_by_id,
+            'first_name': user_first_name,
+            'last_name': user_last_name,
+        },
+        'due_on': action.due_on,
+        'type': action.type,
+        'student_id': action.student_id,
+        'delta_ids': delta_ids,
+        'created_on': action.created_on,
+        'updated_on': action.updated_on,
+        'note': action.note,
+        'is_public': action.is_public,
+    }
 
 
 @login_required
 @require_methods("GET", "PUT", "POST", "DELETE")
 @requires_user_profile
+@condition(etag_func=_action_etag)
 def ActionView(request, requesting_user_profile, action_id=None):
-    def _shape(action: Action):
-        if hasattr(action, 'user_first_name'):
-            user_first_name = action.user_first_name
-            user_last_name = action.user_last_name
-        else:
-            user_first_name = action.created_by.user.first_name
-            user_last_name = action.created_by.user.last_name
-
-        return {
-            'id': action.id,
-            'completed_on': action.completed_on,
-            'created_by': {
-                'user_profile_id': action.created_by_id,
-                'first_name': user_first_name,
-                'last_name': user_last_name,
-            },
-            'due_on': action.due_on,
-            'type': action.type,
-            'student_id': action.student_id,
-            'delta_ids': [d.id for d in action.deltas.all()],
-            'created_on': action.created_on,
-            'updated_on': action.updated_on,
-            'note': action.note,
-            'is_public': action.is_public,
-        }
     if request.method == 'GET':
-        staff_students = (requesting_user_profile
-                          .get_enrolled_students()
-                          .values())
+        filters = {}
+
+        student_id = request.GET.get('student_id', None)
+        if student_id:
+            if not student_id.isdigit():
+                return JsonResponse(
+                    {'error': 'Student id must be a number'},
+                    status=400)
+            filters['student_id'] = student_id
+
+        completed = request.GET.get('completed', None)
+        if completed:
+            if completed not in ('true', 'false'):
+                return JsonResponse(
+                    {'error': 'Completed must be true or false'},
+                    status=400)
+            filters['completed_on__isnull'] = completed == 'false'
+
+        due_before = request.GET.get('due_before', None)
+        if due_before:
+            try:
+                due_before = datetime.strptime(due_before, '%m/%d/%Y %H:%M')
+            except ValueError:
+                return JsonResponse(
+                    {'error': 'Due before must be in the format mm/dd/yyyy HH:MM'},
+                    status=400)
+
+            if settings.USE_TZ:
+                due_before = timezone.make_aware(due_before)
+            filters['due_on__lt'] = due_before
+
+        cursor = request.GET.get('cursor', None)
+        if cursor:
+            try:
+                filters['id__lt'] = int(decode_cursor(cursor, 1)[0])
+            except ValueError:
+                return JsonResponse(
+                    {'error': 'Cursor is not valid'},
+                    status=400)
+
+        limit = request.GET.get('limit', None)
+        if limit:
+            try:
+                limit = int(limit)
+            except ValueError:
+                limit = 0
+            if not 0 < limit <= PAGE_MAX_LIMIT:
+                return JsonResponse(
+                    {'error': f'Limit must be between 1 and {PAGE_MAX_LIMIT}'},
+                    status=400)
+
+        student_ids = TeacherStudentAccess.get_student_ids_for_user_profile(
+            requesting_user_profile.id, current=True)
 
         student_actions = (
             Action.objects
-                .filter(student__in=[s["id"] for s in staff_students])
-                .prefetch_related('deltas')
-                .annotate(user_first_name=F('created_by__user__first_name'),
-                          user_last_name=F('created_by__user__last_name'))
+                .filter(student_id__in=student_ids)
                 .filter(Q(created_by=requesting_user_profile) | Q(is_public=True))
+                .filter(**filters)
+                .annotate(user_first_name=F('created_by__user__first_name'),
+                          user_last_name=F('created_by__user__last_name'),
+                          delta_id_list=ArrayAgg('deltas__id'))
+                .order_by('-id')
         )
 
-        return JsonResponse({'data': [_shape(action) for action in student_actions]})
+        next_cursor = None
+        if limit:
+            # One row past the page tells us whether another page exists
+            student_actions = list(student_actions[:limit + 1])
+            if len(student_actions) > limit:
+                student_actions = student_actions[:limit]
+                next_cursor = encode_cursor(student_actions[-1].id)
+        else:
+            student_actions = student_actions.iterator()
+
+        return streaming_json_response(
+            (_shape_action(action) for action in student_actions),
+            next_cursor=next_cursor)
 
     elif request.method == 'DELETE':
         action = get_object_or_404(Action, id=action_id)
@@ -352,53 +630,8 @@ def ActionView(request, requesting_user_profile, action_id=None):
                 {'error': 'Target student could not be found'},
                 status=404)
 
-        new_action = (Action(
-                        student=target_student,
-                        note=parsed_post.get('note'),
-                        created_by=requesting_user_profile,
-                        is_public=bool(parsed_post.get('is_public'))))
-
-        due_on = parsed_post.get('due_on')
-        completed_on = parsed_post.get('completed_on')
-
-        if due_on:
-            try:
-                due_on = datetime.strptime(due_on, '%m/%d/%Y %H:%M')
-                new_action.due_on = due_on
-            except:
-                return JsonResponse(
-                    {'error': 'Due date must be in the format mm/dd/yyyy HH:MM'},
-                    status=400)
-
-        if completed_on:
-            try:
-                completed_on = datetime.strptime(completed_on, '%m/%d/%Y %H:%M')
-                new_action.completed_on = completed_on
-            except:
-                return JsonResponse(
-                    {'error': 'Completed date must be in the format mm/dd/yyyy HH:MM'},
-                    status=400)
-
-        if parsed_post.get('type'):
-            new_action.type = parsed_post.get('type')
-
-
-        new_action.save()
-
-        delta_ids = parsed_post.get('delta_ids')
-        if delta_ids:
-            if isinstance(delta_ids, list):
-                new_action.deltas = delta_ids
-                new_action.save()
-            else:
-                new_action.delete()
-                return JsonResponse(
-                    {'error': 'Deltas must be a list. Action was not created.'},
-                    status=400)
-
-        return JsonResponse(
-            {'data': _shape(new_action)},
-            status=201)
+        action = Action(student=target_student,
+                        created_by=requesting_user_profile)
     else:
         # Method is PUT
         action_id = parsed_post.get('action_id')
@@ -420,52 +653,228 @@ def ActionView(request, requesting_user_profile, action_id=None):
                     {'error': 'Target student could not be found'},
                     status=404)
 
-        new_note = parsed_post.get('note')
-        if new_note:
-            action.note = new_note
+    error = _apply_action_payload(action, parsed_post)
+    if error:
+        return JsonResponse({'error': error}, status=400)
 
-        due_on = parsed_post.get('due_on')
-        completed_on = parsed_post.get('completed_on')
+    delta_ids, error = _payload_delta_ids(parsed_post)
+    if error:
+        return JsonResponse({'error': error}, status=400)
 
-        if due_on:
-            try:
-                due_on = datetime.strptime(due_on, '%m/%d/%Y %H:%M')
-                action.due_on = due_on
-            except:
-                return JsonResponse(
-                    {'error': 'Due date must be in the format mm/dd/yyyy HH:MM'},
-                    status=400)
+    if delta_ids and \
+            Delta.objects.filter(id__in=delta_ids).count() < len(delta_ids):
+        return JsonResponse(
+            {'error': 'Deltas could not be found'},
+            status=404)
 
-        if completed_on is not False:
-            if completed_on is None:
-                action.completed_on = completed_on
-            else:
-                try:
-                    completed_on = datetime.strptime(completed_on, '%m/%d/%Y %H:%M')
-                    action.completed_on = completed_on
-                except:
-                    return JsonResponse(
-                        {'error': 'Completed date must be in the format mm/dd/yyyy HH:MM'},
-                        status=400)
+    with transaction.atomic():
+        action.save()
+        if delta_ids is not None:
+            action.deltas = delta_ids
 
-        if parsed_post.get('type'):
-            action.type = parsed_post.get('type')
+    return JsonResponse(
+        {'data': _shape_action(action)},
+        status=201 if request.method == 'POST' else 200)
+
+
+def _apply_action_payload(action, payload):
+    """
+    Set the fields present in an action payload on action; fields left
+    out are left alone. Shared by ActionView and ActionBatchView so a
+    payload means the same thing to both. Returns an error message,
+    leaving action part-updated, if any don't parse.
+    """
+    if 'note' in payload:
+        action.note = payload.get('note') or ''
+
+    if 'is_public' in payload:
+        action.is_public = bool(payload.get('is_public'))
+
+    if payload.get('type'):
+        if payload.get('type') not in dict(Action.TYPE_CHOICES):
+            return f"Type must be one of {', '.join(dict(Action.TYPE_CHOICES))}"
+        action.type = payload.get('type')
+
+    for field, label in (('due_on', 'Due date'),
+                         ('completed_on', 'Completed date')):
+        if field not in payload:
+            continue
+        value = payload.get(field)
+        try:
+            value = value and datetime.strptime(value, '%m/%d/%Y %H:%M')
+        except (TypeError, ValueError):
+            return f"{label} must be in the format mm/dd/yyyy HH:MM"
 
-        action.save()
+        if value and settings.USE_TZ:
+            value = timezone.make_aware(value)
+        setattr(action, field, value or None)
 
-        deltas = parsed_post.get('deltas')
-        if deltas:
-            if isinstance(deltas, list):
-                action.deltas = deltas
-                action.save()
-            else:
-                return JsonResponse(
-                    {'error': 'Deltas must be a list. This update to action deltas was ignored.'},
-                    status=400)
+    return None
+
+
+def _payload_delta_ids(payload):
+    """
+    Delta ids from an action payload's delta_ids (or deltas, which PUTs
+    have always sent); an empty list clears the action's deltas.
+    :return: (<sorted ids, or None if neither is present>, error)
+    """
+    payload_deltas = payload.get('delta_ids', payload.get('deltas'))
+    if payload_deltas is None:
+        return None, None
 
+    if not isinstance(payload_deltas, list):
+        return None, 'Deltas must be a list'
+
+    try:
+        return sorted({int(d) for d in payload_deltas}), None
+    except (TypeError, ValueError):
+        return None, 'Ids must be numbers'
+
+
+@login_required
+@require_methods("POST", "PUT")
+@requires_user_profile
+def ActionBatchView(request, requesting_user_profile):
+    """
+    Create (POST) or update (PUT) a list of actions in one transaction.
+    Payloads are those of ActionView, with PUTs naming their action_id;
+    if any payload is invalid nothing is written and the error carries
+    its index.
+    """
+    def _error(message, index, status=400):
+        return JsonResponse({'error': message, 'index': index},
+                            status=status)
+
+    parseable_post = request.body.decode('utf8')
+    if not parseable_post:
         return JsonResponse(
-            {'data': _shape(action)},
-            status=200)
+            {'error': 'Request body must be present'},
+            status=400)
+
+    payloads = loads(parseable_post)
+    if isinstance(payloads, dict):
+        payloads = payloads.get('actions')
+
+    if not isinstance(payloads, list) or not payloads or \
+            not all(isinstance(p, dict) for p in payloads):
+        return JsonResponse(
+            {'error': 'Actions must be a non-empty list of objects'},
+            status=400)
+
+    if len(payloads) > PAGE_MAX_LIMIT:
+        return JsonResponse(
+            {'error': f'At most {PAGE_MAX_LIMIT} actions per batch'},
+            status=400)
+
+    # Coerce ids up front so one query each can check them all
+    student_ids = {}
+    delta_ids = {}
+    action_ids = {}
+    for index, payload in enumerate(payloads):
+        if request.method == 'PUT' and not payload.get('action_id'):
+            return _error('Action id is required parameter', index)
+
+        try:
+            if payload.get('student_id'):
+                student_ids[index] = int(payload.get('student_id'))
+            if request.method == 'PUT':
+                action_ids[index] = int(payload.get('action_id'))
+        except (TypeError, ValueError):
+            return _error('Ids must be numbers', index)
+
+        if request.method == 'POST' and index not in student_ids:
+            return _error('Target student is required parameter', index)
+
+        payload_delta_ids, error = _payload_delta_ids(payload)
+        if error:
+            return _error(error, index)
+        if payload_delta_ids is not None:
+            delta_ids[index] = payload_delta_ids
+
+    found_student_ids = set(
+        Student.objects
+            .filter(id__in=set(student_ids.values()))
+            .values_list('id', flat=True))
+
+    found_delta_ids = set(
+        Delta.objects
+            .filter(id__in={d for ids in delta_ids.values() for d in ids})
+            .values_list('id', flat=True))
+
+    for index, student_id in student_ids.items():
+        if student_id not in found_student_ids:
+            return _error('Target student could not be found', index, 404)
+
+    for index, ids in delta_ids.items():
+        if not found_delta_ids.issuperset(ids):
+            return _error('Deltas could not be found', index, 404)
+
+    if request.method == 'POST':
+        actions = [
+            Action(student_id=student_ids[index],
+                   created_by=requesting_user_profile)
+            for index in range(len(payloads))
+        ]
+    else:
+        existing = {
+            action.id: action for action in
+            Action.objects
+                .filter(id__in=set(action_ids.values()))
+                .annotate(delta_id_list=ArrayAgg('deltas__id'))
+        }
+        actions = []
+        for index in range(len(payloads)):
+            action = existing.get(action_ids[index])
+            if not action:
+                return _error('Action could not be found', index, 404)
+            if action.created_by_id != requesting_user_profile.id:
+                return _error('You cannot update an action you do not own.',
+                              index, 403)
+            if index in student_ids:
+                action.student_id = student_ids[index]
+            actions.append(action)
+
+        if len(existing) < len(actions):
+            return JsonResponse(
+                {'error': 'An action can only appear once per batch'},
+                status=400)
+
+    for index, (action, payload) in enumerate(zip(actions, payloads)):
+        error = _apply_action_payload(action, payload)
+        if error:
+            return _error(error, index)
+
+    through_model = Action.deltas.through
+
+    with transaction.atomic():
+        if request.method == 'POST':
+            actions = Action.objects.bulk_create(actions)
+        else:
+            bulk_update_fields(Action, actions, [
+                'student', 'note', 'is_public', 'type', 'due_on',
+                'completed_on'
+            ])
+            through_model.objects.filter(
+                action_id__in=[actions[index].id for index in delta_ids]
+            ).delete()
+
+        through_model.objects.bulk_create([
+            through_model(action_id=actions[index].id, delta_id=delta_id)
+            for index, ids in delta_ids.items()
+            for delta_id in ids
+        ])
+
+    # Every action here is the requester's, so shaping needs no queries
+    for index, action in enumerate(actions):
+        action.user_first_name = request.user.first_name
+        action.user_last_name = request.user.last_name
+        if index in delta_ids or not hasattr(action, 'delta_id_list'):
+            action.delta_id_list = delta_ids.get(index, [])
+
+    return JsonResponse(
+        {'data': [_shape_action(action) for action in actions]},
+        status=201 if request.method == 'POST' else 200)
+
 
 @csrf_exempt
 @require_methods('POST')
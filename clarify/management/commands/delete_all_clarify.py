@@ -1,5 +1,6 @@
 from django.core.management.base import BaseCommand
 
+from clarify_backend.utils import bump_api_cache_generation
 from ._get_models_to_run import get_models_to_run
 
 
@@ -17,6 +18,8 @@ class Command(BaseCommand):
         for model in models_to_run:
             model.objects.all().delete()
 
+        bump_api_cache_generation()
+
         model_names = [m.__name__ for m in models_to_run]
         out_string = "Completed deletion.\n" \
                      f"Models run: {', '.join(model_names)}\n"
@@ -1,7 +1,9 @@
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 from django.utils import timezone
 
 from clarify.sync import IlluminateSync
+from clarify_backend.utils import bump_api_cache_generation, \
+    bump_api_cache_generation_for_staff_ids
 from ._get_models_to_run import get_models_to_run
 
 
@@ -25,19 +27,55 @@ class Command(BaseCommand):
                             dest="models",
                             nargs="+")
 
+        parser.add_argument('--full',
+                            action='store_true',
+                            dest='full',
+                            default=False,
+                            help="Pull every current score instead of only "
+                                 "those updated since the last sync")
+
+        parser.add_argument('--workers',
+                            dest='workers',
+                            type=int,
+                            default=1,
+                            help="Number of processes to shard staff over")
+
+        parser.add_argument('--district',
+                            action='store_true',
+                            dest='district',
+                            default=False,
+                            help="Sync all current staff in one pass; "
+                                 "ignores staff_ids and --sparse")
+
     def handle(self, *args, **options):
         selected_ids = options["staff_ids"]
         sparse = options["sparse"]
 
-        sync = IlluminateSync(enable_logging=not options['log_disable'])
+        if options["district"] and options["workers"] > 1:
+            raise CommandError("--district syncs in one pass and can't be "
+                               "sharded; drop --workers or --district")
+
+        sync = IlluminateSync(enable_logging=not options['log_disable'],
+                              full=options['full'])
 
         start = timezone.now()
-        result_dict = sync.create_all_for_current_staff(
-            staff_id_list=selected_ids if selected_ids else None,
-            sparse=sparse, models=get_models_to_run(options)
-        )
+        if options["district"]:
+            result_dict = sync.create_all_for_district(
+                models=get_models_to_run(options)
+            )
+        else:
+            result_dict = sync.create_all_for_current_staff(
+                staff_id_list=selected_ids if selected_ids else None,
+                sparse=sparse, models=get_models_to_run(options),
+                workers=options["workers"]
+            )
         end = timezone.now()
 
+        if options["district"] or not selected_ids:
+            bump_api_cache_generation()
+        else:
+            bump_api_cache_generation_for_staff_ids(selected_ids)
+
         minutes, seconds = map(lambda x: round(x), 
                                divmod((end-start).total_seconds(), 60))
                     
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.12 on 2019-02-12 18:05
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('clarify', '0030_leademail'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='gradebook',
+            name='scores_synced_through',
+            field=models.DateTimeField(null=True),
+        ),
+    ]
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.12 on 2019-02-19 14:03
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('clarify', '0031_gradebook_scores_synced_through'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TeacherStudentAccess',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('start_date', models.DateField(null=True)),
+                ('end_date', models.DateField(null=True)),
+                ('section', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='clarify.Section')),
+                ('student', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='clarify.Student')),
+                ('user_profile', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='clarify.UserProfile')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='teacherstudentaccess',
+            index=models.Index(fields=['user_profile', 'start_date', 'end_date', 'student', 'section'], name='clarify_tea_user_pr_8d8887_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='teacherstudentaccess',
+            unique_together=set([('user_profile', 'student', 'section')]),
+        ),
+        migrations.RunSQL(
+            """
+            INSERT INTO clarify_teacherstudentaccess
+                (user_profile_id, student_id, section_id, start_date, end_date)
+            SELECT ssr.user_profile_id, er.student_id, er.section_id,
+                   er.start_date, er.end_date
+            FROM clarify_staffsectionrecord ssr
+            JOIN clarify_enrollmentrecord er ON er.section_id = ssr.section_id
+            """,
+            migrations.RunSQL.noop
+        ),
+    ]
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.12 on 2019-02-20 10:12
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('clarify', '0032_teacherstudentaccess'),
+    ]
+
+    operations = [
+        # Concurrent syncs could insert the same grade level twice;
+        # keep the first of each before the key goes on
+        migrations.RunSQL(
+            """
+            DELETE FROM clarify_sectiongradelevels a
+            USING clarify_sectiongradelevels b
+            WHERE a.section_id = b.section_id
+              AND a.grade_level = b.grade_level
+              AND a.id > b.id
+            """,
+            migrations.RunSQL.noop,
+        ),
+        migrations.AlterUniqueTogether(
+            name='sectiongradelevels',
+            unique_together=set([('section', 'grade_level')]),
+        ),
+    ]
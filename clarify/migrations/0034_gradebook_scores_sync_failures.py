@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.12 on 2019-02-20 11:40
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('clarify', '0033_sectiongradelevels_unique'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='gradebook',
+            name='scores_sync_failures',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+    ]
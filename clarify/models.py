@@ -1,6 +1,6 @@
 from django.contrib.auth.models import User
 from django.contrib.sessions.models import Session
-from django.db import models
+from django.db import models, connection, transaction
 
 from django.db.models import Q, F
 from django.utils import timezone
@@ -100,23 +100,12 @@ class UserProfile(NameInterface, SISMixin, CleverIDMixin, GoogleIDMixin):
         ).distinct('section_id')
 
     def get_enrolled_students(self, *values_list):
-        student_section_teacher_id = "__".join([
-            "enrollmentrecord", "section", "staffsectionrecord", "user_profile_id"
-        ])
-
-        enrolled_now = (
-            Q(enrollmentrecord__start_date__lte=timezone.now()) |
-            Q(enrollmentrecord__start_date__isnull=True),
-            Q(enrollmentrecord__end_date__gte=timezone.now()) |
-            Q(enrollmentrecord__end_date__isnull=True),
-        )
-
         return (
             Student.objects
-                .filter(
-                **{student_section_teacher_id: self.id})
-                .filter(*enrolled_now)
-                .annotate(section_id=F("enrollmentrecord__section_id"))
+                .filter(*TeacherStudentAccess.enrolled_now(
+                            "teacherstudentaccess__"),
+                        teacherstudentaccess__user_profile_id=self.id)
+                .annotate(section_id=F("teacherstudentaccess__section_id"))
                 .distinct('id', 'section_id')
         )
 
@@ -229,6 +218,9 @@ class SectionGradeLevels(models.Model):
     grade_level = models.CharField(max_length=2, choices=GRADE_LEVEL_CHOICES)
     section = models.ForeignKey(Section)
 
+    class Meta:
+        unique_together = ('section', 'grade_level')
+
 
 class EnrollmentRecord(models.Model):
     student = models.ForeignKey(Student)
@@ -253,6 +245,81 @@ class StaffSectionRecord(models.Model):
         unique_together = ('user_profile', 'section')
 
 
+class TeacherStudentAccess(models.Model):
+    """
+    Denormalized StaffSectionRecord x EnrollmentRecord: which students a
+    teacher sees, through which section, over the enrollment's window.
+    Rebuilt by refresh at the end of each sync.
+    """
+    user_profile = models.ForeignKey(UserProfile)
+    student = models.ForeignKey(Student)
+    section = models.ForeignKey(Section)
+    start_date = models.DateField(null=True)
+    end_date = models.DateField(null=True)
+
+    class Meta:
+        unique_together = ('user_profile', 'student', 'section')
+        indexes = [
+            # Covers teacher lookups without touching the table
+            models.Index(fields=['user_profile', 'start_date', 'end_date',
+                                 'student', 'section']),
+        ]
+
+    @staticmethod
+    def enrolled_now(prefix=""):
+        """Q filters for rows whose enrollment window includes today"""
+        now = timezone.now()
+
+        return (
+            Q(**{f"{prefix}start_date__lte": now}) |
+            Q(**{f"{prefix}start_date__isnull": True}),
+            Q(**{f"{prefix}end_date__gte": now}) |
+            Q(**{f"{prefix}end_date__isnull": True}),
+        )
+
+    @classmethod
+    def get_student_ids_for_user_profile(cls, profile_id, current=False):
+        """Student ids subquery for a teacher, optionally enrolled today"""
+        filters = cls.enrolled_now() if current else ()
+        return (cls.objects
+                .filter(*filters, user_profile_id=profile_id)
+                .values('student_id'))
+
+    @classmethod
+    def refresh(cls, user_profile_ids=None):
+        """
+        Rebuild the rows for every section the given profiles teach
+        (so co-teachers stay in step), or the whole table without ids
+        :return: rows written
+        """
+        delete_filter = ""
+        insert_filter = ""
+        params = []
+        if user_profile_ids is not None:
+            sections = f"""
+                SELECT section_id FROM {StaffSectionRecord._meta.db_table}
+                WHERE user_profile_id = ANY(%s)"""
+            delete_filter = f"WHERE section_id IN ({sections})"
+            insert_filter = f"WHERE ssr.section_id IN ({sections})"
+            params.append(list(user_profile_ids))
+
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(
+                f"DELETE FROM {cls._meta.db_table} {delete_filter}", params)
+            cursor.execute(f"""
+                INSERT INTO {cls._meta.db_table}
+                    (user_profile_id, student_id, section_id,
+                     start_date, end_date)
+                SELECT ssr.user_profile_id, er.student_id, er.section_id,
+                       er.start_date, er.end_date
+                FROM {StaffSectionRecord._meta.db_table} ssr
+                JOIN {EnrollmentRecord._meta.db_table} er
+                  ON er.section_id = ssr.section_id
+                {insert_filter}
+            """, params)
+            return cursor.rowcount
+
+
 class StaffAdminRecord(models.Model):
     user_profile = models.ForeignKey(UserProfile)
     term = models.ForeignKey(Term)
@@ -286,6 +353,10 @@ class Gradebook(BaseNameModel):
     section = models.ForeignKey(Section)
     # Some gradebooks have multiple owners / viewers
     owners = models.ManyToManyField(UserProfile)
+    # ScoreCache.last_updated high-water mark of the last clean Score sync
+    scores_synced_through = models.DateTimeField(null=True)
+    # Score syncs in a row that held the mark back over failed rows
+    scores_sync_failures = models.PositiveSmallIntegerField(default=0)
 
     @classmethod
     def get_all_current_gradebook_ids_for_user_profile(cls, profile_id):
@@ -4,8 +4,9 @@ from httplib2 import Http
 from tqdm import tqdm
 
 from django.contrib.auth.models import User
-from django.db.models import Model
-from django.db.utils import IntegrityError
+from django.db.models import Model, F
+from django.db.models.query import QuerySet
+from django.db.utils import IntegrityError, OperationalError
 
 from googleapiclient.discovery import build
 from oauth2client import client
@@ -18,8 +19,10 @@ from clarify.models import (
     Section,
     EnrollmentRecord,
     StaffSectionRecord,
+    TeacherStudentAccess,
     Gradebook, Category, Assignment, Score, SectionGradeLevels)
 
+from deltas.tasks import queue_category_deltas_for_score_ids
 from sis_mirror.models import (
     Sites,
     Terms,
@@ -27,21 +30,94 @@ from sis_mirror.models import (
     Sections,
     SectionStudentAff,
     Gradebooks,
+    GradebookSectionCourseAff,
     Categories,
     Assignments,
     ScoreCache,
     Users)
 
-from clarify_backend.utils import try_bulk_or_skip_errors
+from clarify_backend.utils import (
+    try_bulk_or_skip_errors,
+    upsert_or_skip_errors,
+    imap_with_process_pool,
+    iterate_in_batches,
+    bump_api_cache_generation
+)
+
+
+class SourceIdResolver:
+    """
+    Maps source ids to Clarify ids for foreign keys during a sync.
+
+    The whole { <source_id>: <clarify_id> } map for a model is loaded
+    with one values_list query the first time the model is referenced,
+    then kept current with the ids returned by each bulk upsert. A miss
+    (eg. a row written by another process mid-sync) costs one lookup,
+    and the result, found or not, is remembered.
+    """
+
+    def __init__(self, id_field):
+        self.id_field = id_field
+        # { <model>: { <source_id>: <clarify_id or None> } }
+        self.id_maps = {}
+        self.hits = 0
+        self.misses = 0
+
+    def preload(self, model):
+        if model in self.id_maps:
+            return
+
+        self.id_maps[model] = dict(
+            model.objects
+                .filter(**{f"{self.id_field}__isnull": False})
+                .values_list(self.id_field, 'id')
+        )
+
+    def update(self, model, id_map):
+        if model in self.id_maps:
+            self.id_maps[model].update(id_map)
+
+    def resolve(self, model, source_id):
+        self.preload(model)
+        id_map = self.id_maps[model]
+
+        if source_id in id_map:
+            self.hits += 1
+            return id_map[source_id]
+
+        self.misses += 1
+        clarify_id = (model.objects
+                      .filter(**{self.id_field: source_id})
+                      .values_list('id', flat=True)
+                      .first())
+        id_map[source_id] = clarify_id
+
+        return clarify_id
+
+    def stats_string(self):
+        loaded = ", ".join(f"{model.__name__}: {len(id_map)}"
+                           for model, id_map in self.id_maps.items())
+        return f"FK resolution: {self.hits} hits, {self.misses} misses " + \
+               f"({loaded})"
+
+
+# Rows read from the source and upserted per round trip
+SYNC_BATCH_SIZE = 2000
+
+# Score stages in a row a failing gradebook holds its mark back for
+SCORE_SYNC_MAX_HELD_BACK = 3
 
 
 class Sync:
     source_id_field = None
     model_args_map = None
 
-    def __init__(self, logger=None, enable_logging=True):
+    def __init__(self, logger=None, enable_logging=True, progress=True):
         self.logger = (logger or print) if enable_logging else None
-        self.memo = {}
+        # Per-model tqdm bars; off in pool workers, whose bars would
+        # write over each other
+        self.progress = progress
+        self.resolver = SourceIdResolver(self.source_id_field)
 
     def log(self, *args, **kwargs):
         if self.logger:
@@ -98,12 +174,15 @@ class Sync:
             name = model_kwargs.get("name", first_name + " " + last_name)
             prefix = model_kwargs.get("prefix", "")
 
+            user_profile = UserProfile.objects.create(
+                user=user, name=name, prefix=prefix, **{id_field: source_id}
+            )
+            self.resolver.update(UserProfile, {source_id: user_profile.id})
+
             # match signature of Model.objects.get_or_create:
             # > Returns a tuple of (object, created)
 
-            return UserProfile.objects.create(
-                user=user, name=name, prefix=prefix, **{id_field: source_id}
-            ), 1
+            return user_profile, 1
 
         # match signature of Model.objects.get_or_create:
         # > Returns a tuple of (object, created)
@@ -111,6 +190,56 @@ class Sync:
             id_field: source_id
         }), 0
 
+    def get_upsert_conflict_fields(self, model, kwargs_list):
+        """
+        Unique key the bulk upsert conflicts on: the source id field
+        when the model carries one, else the model's unique_together
+        """
+        if self.source_id_field in kwargs_list:
+            return self.source_id_field,
+
+        return tuple(model._meta.get_field(f).attname
+                     for f in model._meta.unique_together[0])
+
+    @staticmethod
+    def add_gradebook_owners(owner_pairs):
+        """
+        Create any missing gradebook ownership rows
+        :param owner_pairs: iterable of (gradebook_id, user_profile_id)
+        """
+        through = Gradebook.owners.through
+        owner_pairs = set(owner_pairs)
+
+        owned = set(through.objects
+                    .filter(gradebook_id__in={g for g, _ in owner_pairs})
+                    .values_list('gradebook_id', 'userprofile_id'))
+
+        through.objects.bulk_create([
+            through(gradebook_id=gradebook_id, userprofile_id=profile_id)
+            for gradebook_id, profile_id in owner_pairs - owned
+        ])
+
+    @staticmethod
+    def add_section_grade_levels(section_grade_levels):
+        """
+        Create grade levels for sections that don't have any yet
+        :param section_grade_levels: { <section_id>: <grade_level> }
+        """
+        section_grade_levels = {k: v for k, v in section_grade_levels.items()
+                                if v}
+
+        has_grade_levels = set(SectionGradeLevels.objects
+                               .filter(section_id__in=section_grade_levels)
+                               .values_list('section_id', flat=True))
+
+        # Pool workers can sync the same section at once, so the insert
+        # goes through the unique (section, grade_level) key
+        upsert_or_skip_errors(SectionGradeLevels, [
+            {'section_id': section_id, 'grade_level': grade_level}
+            for section_id, grade_level in section_grade_levels.items()
+            if section_id not in has_grade_levels
+        ], ('section_id', 'grade_level'))
+
     """ All methods below pull only current records """
 
     @classmethod
@@ -175,12 +304,41 @@ class Sync:
     def get_all_current_staff_ids_from_source(cls):
         return None
 
+    @classmethod
+    def get_source_related_gradebook_owners(cls):
+        """Return { sis_gradebook_id, sis_user_id } for all current staff"""
+        return None
+
+    def on_row_failed(self, model, instance):
+        """Called for each source row a model stage couldn't sync"""
+        return None
+
+    def on_model_synced(self, model, new_count, errors):
+        """Called after each model stage of create_all_from_source"""
+        return None
+
     def create_all_for_staff_from_source(self, source_id, models=None):
+        staff, staff_created = self.get_or_create_staff(source_id)
+
+        if staff_created:
+            self.log(f"Staff created for {self.source_id_field} {source_id}")
+
+        return self.create_all_from_source(source_id, staff=staff,
+                                           models=models)
+
+    def create_all_from_source(self, source_id=None, staff=None, models=None):
+        """
+        Build every model in model_args_map from the source.
+
+        With a source_id, query funcs are scoped to that staff member
+        and new gradebooks are owned by staff. Without one, query funcs
+        are called with None (all current staff) and gradebook owners
+        come from get_source_related_gradebook_owners.
+        """
 
         return_dict = {}
 
         id_field = self.source_id_field
-        success_string = ""
 
         model_map = {m.__name__.lower(): m for m in [
             Site, Term, Section, Student, Gradebook,
@@ -189,81 +347,83 @@ class Sync:
 
         model_map["user"] = UserProfile
 
-        staff, staff_created = self.get_or_create_staff(source_id)
+        resolver = self.resolver
 
-        if staff_created:
-            success_string += f"Staff created for " + \
-                              f"{id_field} {source_id}\n"
+        def _get_related_model(fk_id_field):
+            split_text = fk_id_field.split('_')
+            if len(split_text) < 3:
+                raise ValueError('Improper field format.')
 
-        # { <model> { <source_id> : <clarify_id> } }
-        memoized_related = self.memo
+            return model_map["".join(split_text[1:-1])]
 
         def _get_related_model_field_and_id(fk_id_field, source_id):
             if not source_id:
                 return None
 
-            split_text = fk_id_field.split('_')
-            if len(split_text) < 3:
-                raise ValueError('Improper field format.')
-
-            related_model_name = "".join(split_text[1:-1])
-
-            related_field_key = "_".join(split_text[1:])
+            related_field_key = "_".join(fk_id_field.split('_')[1:])
 
             if related_field_key == "user_id":
                 related_field_key = "user_profile_id"
 
-            if related_model_name in memoized_related and \
-               source_id in memoized_related[related_model_name]:
-                clarify_id = memoized_related[related_model_name][source_id]
-                return related_field_key, clarify_id
-
-            related_model: Model = model_map[related_model_name]
+            related_model: Model = _get_related_model(fk_id_field)
 
-            try:
-                clarify_id = (related_model.objects
-                                           .get(**{id_field: source_id})
-                                           .id)
-            except related_model.DoesNotExist:
+            clarify_id = resolver.resolve(related_model, source_id)
+            if clarify_id is None:
                 return None
 
-            if related_model_name not in memoized_related:
-                memoized_related[related_model_name] = {}
-
-            memoized_related[related_model_name][source_id] = clarify_id
-
             return related_field_key, clarify_id
 
-        def _try_create_or_return_none(model: Model, **new_kwargs):
-            error = False
-            try:
-                new_instance, created = (model
-                                         .objects
-                                         .get_or_create(**new_kwargs))
-            except (model.MultipleObjectsReturned, IntegrityError):
-                new_instance, created = (None, None)
-                error = True
-
-            return new_instance, created, error
+        def _get_source_gradebook_owners():
+            owners = []
+            for owner in self.get_source_related_gradebook_owners() or []:
+                fk_kwargs = dict(filter(
+                    lambda x: x is not None,
+                    [_get_related_model_field_and_id(f, owner.get(f))
+                     for f in ['sis_gradebook_id', 'sis_user_id']]
+                ))
+                if len(fk_kwargs) == 2:
+                    owners.append((fk_kwargs['gradebook_id'],
+                                   fk_kwargs['user_profile_id']))
+            return owners
 
         def _build_all_models(model: Model, related_query_func,
                               kwargs_list, fk_field_list=None):
 
             source_models = related_query_func(source_id)
-            count = 0
-            errors = 0
-            bulk = []
-
-            if source_models and len(source_models) > 0:
-
-                if len(source_models) > 40:
-                    iterator = tqdm(source_models,
-                                     desc=model.__name__,
-                                     leave=False)
-                else:
-                    iterator = source_models
-
-                for instance in iterator:
+            count, errors = 0, 0
+
+            # Rows missing a required FK can't be inserted; count them
+            # as errors up front instead of failing the whole batch
+            required_fk_fields = [
+                f.attname for f in model._meta.concrete_fields
+                if f.is_relation and not f.null
+            ]
+
+            conflict_fields = self.get_upsert_conflict_fields(model,
+                                                              kwargs_list)
+
+            for fk_field in fk_field_list or []:
+                resolver.preload(_get_related_model(fk_field))
+
+            # Querysets are streamed off a server-side cursor and
+            # upserted SYNC_BATCH_SIZE rows at a time, so memory stays
+            # flat however many rows the source returns
+            if isinstance(source_models, QuerySet):
+                source_models = source_models.iterator()
+
+            iterator = tqdm(source_models or [],
+                            desc=model.__name__,
+                            leave=False,
+                            disable=not self.progress)
+
+            for batch in iterate_in_batches(iterator, SYNC_BATCH_SIZE):
+                rows = []
+                # { id(<row>): <source instance> } to report failed rows
+                instances = {}
+                # { <source_id>: <grade_level> } for sections
+                grade_levels = {}
+
+                for instance in batch:
                     new_kwargs = {
                         k: instance.get(k) for k in kwargs_list
                     }
@@ -281,43 +441,55 @@ class Sync:
                         new_fk_kwargs = {i[0]: i[1] for i in fk_tuple}
                         new_kwargs.update(new_fk_kwargs)
 
-                    # Try and bulk create models with many more rows
-                    if model in [Assignment, Section]:
-                        bulk.append(new_kwargs)
-
-                    else:
-                        new_instance, created, did_error = \
-                            _try_create_or_return_none(model, **new_kwargs)
-
-                        if created:
-                            count += 1
-                        if did_error:
-                            errors += 1
-
-                        if (isinstance(new_instance, Gradebook) and
-                           not new_instance.owners.filter(sis_id=source_id).exists()):
-                            new_instance.owners.add(staff)
-
-                        if (isinstance(new_instance, Section) and
-                                not new_instance.sectiongradelevels_set.exists()
-                                and instance.get('grade_level')):
-                            SectionGradeLevels.objects.create(
-                                grade_level=instance.get('grade_level'),
-                                section=new_instance
-                        )
+                    if any(f not in new_kwargs for f in required_fk_fields):
+                        errors += 1
+                        self.on_row_failed(model, instance)
+                        continue
+
+                    if model is Section:
+                        grade_levels[new_kwargs.get(id_field)] = \
+                            instance.get('grade_level')
+
+                    rows.append(new_kwargs)
+                    instances[id(new_kwargs)] = instance
+
+                failed_rows = []
+                # Unchanged scores are left alone so that only real
+                # changes queue their category deltas for rebuilding
+                batch_count, upsert_errors, upserted = upsert_or_skip_errors(
+                    model, rows, conflict_fields,
+                    changed_only=model is Score,
+                    failed_rows=failed_rows
+                )
+                count += batch_count
+                errors += upsert_errors
 
-            if len(bulk) > 0:
-                bulk_models = [model(**kwargs) for kwargs in bulk]
-                try:
-                    model.objects.bulk_create(bulk_models)
-                except IntegrityError:
-                    for kwargs in bulk:
-                        new_instance, created, did_error = \
-                            _try_create_or_return_none(model, **kwargs)
-                        if created:
-                            count += 1
-                        if did_error:
-                            errors += 1
+                for row in failed_rows:
+                    self.on_row_failed(model, instances[id(row)])
+
+                if model is Score:
+                    queue_category_deltas_for_score_ids(upserted.values())
+
+                if conflict_fields == (id_field,):
+                    resolver.update(model, {
+                        key[0]: clarify_id
+                        for key, clarify_id in upserted.items()
+                    })
+
+                if model is Gradebook and staff:
+                    self.add_gradebook_owners(
+                        (gradebook_id, staff.id)
+                        for gradebook_id in upserted.values()
+                    )
+
+                if model is Section:
+                    self.add_section_grade_levels({
+                        section_id: grade_levels.get(key[0])
+                        for key, section_id in upserted.items()
+                    })
+
+            if model is Gradebook and not staff:
+                self.add_gradebook_owners(_get_source_gradebook_owners())
 
             return count, errors
 
@@ -334,14 +506,25 @@ class Sync:
             args = [model, query_func] + list(model_args)
 
             new_count, new_errors = _build_all_models(*args)
+            self.on_model_synced(model, new_count, new_errors)
 
             if new_count > 0 or new_errors > 0:
                 return_dict[model_name] = [new_count, new_errors]
 
+        if {StaffSectionRecord, EnrollmentRecord} & set(models_to_run):
+            TeacherStudentAccess.refresh([staff.id] if staff else None)
+
         return return_dict
 
 
 class IlluminateSync(Sync):
+    """
+    Scores are synced incrementally: each Gradebook keeps the
+    ScoreCache.last_updated mark of the last Score stage all its rows
+    synced in (or of the SCORE_SYNC_MAX_HELD_BACK'th stage in a row
+    that some didn't), and only scores updated after it are pulled.
+    Pass full=True to pull them all.
+    """
 
     source_id_field = 'sis_id'
     model_args_map = {
@@ -367,6 +550,16 @@ class IlluminateSync(Sync):
                 ['sis_student_id', 'sis_assignment_id'])
     }
 
+    def __init__(self, logger=None, enable_logging=True, full=False,
+                 progress=True):
+        super().__init__(logger=logger, enable_logging=enable_logging,
+                         progress=progress)
+        self.full = full
+        # (sis gradebook ids, last_updated mark) of the Score stage running
+        self.pending_scores_mark = None
+        # { <sis gradebook id>: [<score sis ids that failed this stage>] }
+        self.failed_score_ids = {}
+
     @classmethod
     def get_source_related_staff_for_staff_id(cls, staff_id):
         return Users.get_staff_values_for_staff_id(staff_id)
@@ -407,17 +600,102 @@ class IlluminateSync(Sync):
     def get_source_related_assignments_for_staff_id(cls, staff_id):
         return Assignments.get_current_assignments_for_staff_id(staff_id)
 
+    def get_source_related_scores_for_staff_id(self, staff_id):
+        gradebook_ids = list(
+            Gradebooks
+                .get_current_gradebooks_for_staff_id(staff_id)
+                .values_list('sis_id', flat=True)
+        )
+
+        # Taken before the scores are read, so anything updated while
+        # they're pulled is picked up again next run
+        self.pending_scores_mark = (
+            gradebook_ids,
+            ScoreCache.get_last_updated_for_gradebook_ids(gradebook_ids)
+        )
+        self.failed_score_ids = {}
+
+        updated_since = None
+        if not self.full:
+            updated_since = dict(
+                Gradebook.objects
+                    .filter(sis_id__in=gradebook_ids,
+                            scores_synced_through__isnull=False)
+                    .values_list('sis_id', 'scores_synced_through')
+            )
+
+        return ScoreCache.get_current_scores_for_staff_id(
+            staff_id, updated_since=updated_since)
+
+    def on_row_failed(self, model, instance):
+        if model is Score:
+            self.failed_score_ids.setdefault(
+                instance.get('sis_gradebook_id'), []
+            ).append(instance.get('sis_id'))
+
+    def on_model_synced(self, model, new_count, errors):
+        if model is not Score or not self.pending_scores_mark:
+            return None
+
+        gradebook_ids, mark = self.pending_scores_mark
+        self.pending_scores_mark = None
+
+        if mark is None:
+            return None
+
+        gradebooks = Gradebook.objects.filter(sis_id__in=gradebook_ids)
+
+        updated = (gradebooks
+                   .exclude(sis_id__in=self.failed_score_ids)
+                   .update(scores_synced_through=mark,
+                           scores_sync_failures=0))
+
+        # Failed rows have to be pulled again, so a gradebook with any
+        # holds its mark back, but only for SCORE_SYNC_MAX_HELD_BACK
+        # stages in a row: a row that never syncs mustn't turn every
+        # later run into a full pull of its gradebook
+        failing = gradebooks.filter(sis_id__in=self.failed_score_ids)
+        failing.update(scores_sync_failures=F('scores_sync_failures') + 1)
+
+        given_up = failing.filter(
+            scores_sync_failures__gte=SCORE_SYNC_MAX_HELD_BACK)
+        for gradebook_id in given_up.values_list('sis_id', flat=True):
+            self.log(f"Gradebook {gradebook_id}: scores "
+                     f"{self.failed_score_ids[gradebook_id]} failed "
+                     f"{SCORE_SYNC_MAX_HELD_BACK} syncs in a row; "
+                     f"moving its mark past them")
+
+        return updated + given_up.update(scores_synced_through=mark,
+                                         scores_sync_failures=0)
+
     @classmethod
-    def get_source_related_scores_for_staff_id(cls, staff_id):
-        return ScoreCache.get_current_scores_for_staff_id(staff_id)
+    def get_source_related_gradebook_owners(cls):
+        return GradebookSectionCourseAff.get_current_gradebook_owners()
 
     @classmethod
     def get_all_current_staff_ids_from_source(cls):
         return Users.get_all_current_staff_ids()
 
+    def create_all_for_district(self, models=None):
+        """
+        Sync all current staff at once: each mirror table is queried
+        once for the whole district rather than once per teacher, and
+        gradebook ownership is attached after the rows are built.
+        """
+        staff_ids = self.get_all_current_staff_ids_from_source()
+
+        for staff_id in tqdm(staff_ids, desc="Staff", leave=False,
+                             disable=not self.progress):
+            self.get_or_create_staff(staff_id)
+
+        result_dict = self.create_all_from_source(models=models)
+        self.log(self.resolver.stats_string())
+
+        return result_dict
+
     def create_all_for_current_staff(self, staff_id_list=None,
                                      # used for rapid testing
-                                     sparse=False, models=None):
+                                     sparse=False, models=None, workers=1):
         total_result_dict = {}
 
         staff_ids = staff_id_list if staff_id_list else \
@@ -426,19 +704,68 @@ class IlluminateSync(Sync):
         if sparse:
             staff_ids = staff_ids[::20]
 
-        for staff_id in tqdm(staff_ids, desc="Staff"):
-            result_dict = self.create_all_for_staff_from_source(staff_id,
-                                                                models=models)
-            for model_name, outcome_list in result_dict.items():
-                if model_name not in total_result_dict:
-                    total_result_dict[model_name] = outcome_list
-                else:
-                    total_result_dict[model_name][0] += outcome_list[0]
-                    total_result_dict[model_name][1] += outcome_list[1]
+        if workers > 1:
+            results = imap_with_process_pool(
+                _create_all_for_staff_in_worker,
+                [(staff_id, models, self.full) for staff_id in staff_ids],
+                workers
+            )
+        else:
+            results = (
+                self.create_all_for_staff_from_source(staff_id, models=models)
+                for staff_id in staff_ids
+            )
+
+        for result_dict in tqdm(results, desc="Staff", total=len(staff_ids)):
+            self.merge_result_dicts(total_result_dict, result_dict)
+
+        if workers == 1:
+            self.log(self.resolver.stats_string())
+
+        return total_result_dict
+
+    @staticmethod
+    def merge_result_dicts(total_result_dict, result_dict):
+        for model_name, outcome_list in result_dict.items():
+            if model_name not in total_result_dict:
+                total_result_dict[model_name] = outcome_list
+            else:
+                total_result_dict[model_name][0] += outcome_list[0]
+                total_result_dict[model_name][1] += outcome_list[1]
 
         return total_result_dict
 
 
+# Each pool worker keeps its own sync (and resolver) across staff ids
+_worker_sync = None
+
+SYNC_WORKER_ATTEMPTS = 3
+
+
+def _create_all_for_staff_in_worker(args):
+    """
+    Process pool entry point for IlluminateSync.create_all_for_current_staff.
+
+    Workers share rows like Sections and Students with each other, so a
+    staff member whose sync hits a unique race or deadlock is retried;
+    the upserts make a retry safe.
+    """
+    global _worker_sync
+    staff_id, models, full = args
+
+    if _worker_sync is None:
+        _worker_sync = IlluminateSync(enable_logging=False, full=full,
+                                      progress=False)
+
+    for attempt in range(SYNC_WORKER_ATTEMPTS):
+        try:
+            return _worker_sync.create_all_for_staff_from_source(
+                staff_id, models=models)
+        except (IntegrityError, OperationalError):
+            if attempt == SYNC_WORKER_ATTEMPTS - 1:
+                raise
+
+
 class CleverSync(Sync):
     model_args_map = {
         Site: (['clever_id', 'name'],),
@@ -615,6 +942,9 @@ class CleverSync(Sync):
                                                        enrollments)
             self.log(f"ENROLLMENTS NEW: {enr_new}, ENROLLMENTS ERR: {enr_err}")
 
+        TeacherStudentAccess.refresh([user_profile.id])
+        bump_api_cache_generation([user_profile.id])
+
 
 class GoogleClassroomSync(Sync):
     model_args_map = {
@@ -722,4 +1052,7 @@ class GoogleClassroomSync(Sync):
         self.create_sections_for_staff(user_profile)
         self.create_students_for_staff(user_profile)
 
+        TeacherStudentAccess.refresh([user_profile.id])
+        bump_api_cache_generation([user_profile.id])
+
         return user_profile
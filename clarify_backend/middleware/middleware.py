@@ -24,7 +24,8 @@ class NonHtmlDebugToolbarMiddleware(object):
                     'Length: {}</body></html>'.format(len(response.content))
                 response = HttpResponse(new_content)
             elif response['Content-Type'] != 'text/html':
-                content = response.content
+                content = b''.join(response.streaming_content) \
+                    if response.streaming else response.content
 
                 # Check for compression
                 if 'content-encoding' in response:
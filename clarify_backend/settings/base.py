@@ -110,6 +110,25 @@ DATABASES = {
 
 DATABASE_ROUTERS = ['sis_mirror.routers.MirrorRouter']
 
+# Per-teacher API response cache (see decorators.cache_per_user_profile).
+# A table in the default database, so the generation bumps made by sync
+# and delta commands (one-off and worker dynos) reach every web dyno;
+# create it with `./manage.py createcachetable`. API_CACHE_BACKEND can
+# point it at another shared store, eg. Redis.
+CACHES = {
+    'default': {
+        'BACKEND': env('API_CACHE_BACKEND',
+                       default='django.core.cache.backends.db.DatabaseCache'),
+        'LOCATION': env('API_CACHE_LOCATION', default='clarify_api_cache'),
+        'OPTIONS': {
+            'MAX_ENTRIES': env.int('API_CACHE_MAX_ENTRIES', default=50000),
+        },
+    }
+}
+API_CACHE_TIMEOUT = env.int('API_CACHE_TIMEOUT', default=60 * 60 * 24)
+# Larger responses (in bytes) are served uncached
+API_CACHE_MAX_SIZE = env.int('API_CACHE_MAX_SIZE', default=2 * 1024 * 1024)
+
 # Include schema in sis_mirror models db_table reference
 # db_table references will be <schema>.<table> (except for 'public' schema)
 SIS_MIRROR_WITH_SCHEMA = env.bool('SIS_MIRROR_WITH_SCHEMA', default=False)
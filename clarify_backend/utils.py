@@ -1,17 +1,26 @@
 import re
 import json
+import time
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import OrderedDict
+from itertools import islice
+from multiprocessing import Pool
 from random import sample
 from datetime import datetime
 
-from django.db import models, IntegrityError
+from django.db import (
+    models, connections, router, transaction, IntegrityError, DataError
+)
 from django.contrib.auth.models import User
 from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
 from sendgrid import Email
 from sendgrid.helpers.mail import Content, Mail
 
 from clarify.models import (
     UserProfile, Section, Student, EnrollmentRecord,
-    StaffSectionRecord, Site, Term
+    StaffSectionRecord, TeacherStudentAccess, Site, Term
 )
 
 with open('clarify_backend/_words.json') as infile:
@@ -35,6 +44,330 @@ def try_bulk_or_skip_errors(model, instance_list):
 
     return new, errors
 
+
+def upsert_or_skip_errors(model, rows, conflict_fields, batch_size=1000,
+                          changed_only=False, failed_rows=None):
+    """
+    Set-based INSERT ... ON CONFLICT (<conflict_fields>) DO UPDATE.
+
+    Rows are dicts keyed by field attname. Columns missing from a row
+    fall back to the field default (or now, for auto_now fields) on
+    insert; on conflict only the columns present in the rows, plus any
+    auto_now fields, are updated.
+
+    A batch that fails (eg. a second unique constraint, or a null in a
+    required column) is retried row by row so one bad row doesn't sink
+    the rest of the batch.
+
+    :param model: Model class to upsert into
+    :param rows: list of { attname: value } dicts
+    :param conflict_fields: attnames of a unique constraint on model
+    :param changed_only: skip the update (and leave the row out of
+        upserted) when the existing row already has the same values
+    :param failed_rows: optional list the rows that couldn't be
+        upserted are appended to
+    :return: (new, errors, upserted) where upserted is
+        { (<conflict values>): <pk> } for every inserted or updated row
+    """
+    new, errors, upserted = 0, 0, {}
+
+    # Postgres won't update the same row twice in one statement,
+    # so collapse rows on every unique key we know about (last wins)
+    unique_keys = [tuple(conflict_fields)] + [
+        tuple(model._meta.get_field(f).attname for f in fields)
+        for fields in model._meta.unique_together
+    ]
+    for key_fields in unique_keys:
+        deduped = OrderedDict()
+        for row in rows:
+            if any(row.get(f) is None for f in key_fields):
+                deduped[id(row)] = row
+            else:
+                deduped[tuple(row[f] for f in key_fields)] = row
+        rows = list(deduped.values())
+
+    # Upsert in key order so concurrent writers take row locks in the
+    # same order instead of deadlocking
+    rows.sort(key=lambda row: tuple((row.get(f) is None, row.get(f) or 0)
+                                    for f in conflict_fields))
+
+    if not rows:
+        return new, errors, upserted
+
+    db = router.db_for_write(model)
+    connection = connections[db]
+    qn = connection.ops.quote_name
+
+    opts = model._meta
+    fields = [f for f in opts.concrete_fields if not f.primary_key]
+    present = {k for row in rows for k in row.keys()}
+    update_fields = [f.attname for f in fields
+                     if (f.attname in present or getattr(f, 'auto_now', False))
+                     and f.attname not in conflict_fields] or \
+        [conflict_fields[0]]
+
+    returning = [opts.pk.attname] + list(conflict_fields)
+    row_sql = "(" + ", ".join(["%s"] * len(fields)) + ")"
+
+    where_changed = ""
+    if changed_only:
+        table = qn(opts.db_table)
+        # auto_now columns always differ, so leave them out
+        compared = [c for c in update_fields if c in present] or update_fields
+        where_changed = (
+            f" WHERE ({', '.join(f'{table}.{qn(c)}' for c in compared)})"
+            f" IS DISTINCT FROM "
+            f"({', '.join(f'EXCLUDED.{qn(c)}' for c in compared)})"
+        )
+
+    def _sql(row_count):
+        return (
+            f"INSERT INTO {qn(opts.db_table)} "
+            f"({', '.join(qn(f.column) for f in fields)}) "
+            f"VALUES {', '.join([row_sql] * row_count)} "
+            f"ON CONFLICT ({', '.join(qn(c) for c in conflict_fields)}) "
+            f"DO UPDATE SET " +
+            ", ".join(f"{qn(c)} = EXCLUDED.{qn(c)}" for c in update_fields) +
+            where_changed +
+            f" RETURNING {', '.join(qn(c) for c in returning)}, "
+            f"(xmax = 0) AS inserted"
+        )
+
+    now = timezone.now()
+
+    def _value(field, row):
+        if field.attname in row:
+            return row[field.attname]
+        if getattr(field, 'auto_now', False) or \
+                getattr(field, 'auto_now_add', False):
+            return now
+        return field.get_default()
+
+    def _params(row):
+        return [f.get_db_prep_save(_value(f, row), connection)
+                for f in fields]
+
+    def _execute(batch):
+        params = [p for row in batch for p in _params(row)]
+        with transaction.atomic(using=db), connection.cursor() as cursor:
+            cursor.execute(_sql(len(batch)), params)
+            return cursor.fetchall()
+
+    for i in range(0, len(rows), batch_size):
+        batch = rows[i:i + batch_size]
+
+        try:
+            results = _execute(batch)
+        except (IntegrityError, DataError):
+            results = []
+            for row in batch:
+                try:
+                    results += _execute([row])
+                except (IntegrityError, DataError):
+                    errors += 1
+                    if failed_rows is not None:
+                        failed_rows.append(row)
+
+        for result in results:
+            upserted[tuple(result[1:-1])] = result[0]
+            if result[-1]:
+                new += 1
+
+    return new, errors, upserted
+
+
+def bulk_update_fields(model, objs, field_names, batch_size=1000):
+    """
+    Write field_names of saved instances in one UPDATE ... FROM (VALUES
+    ...) per batch, as this Django has no bulk_update. auto_now fields
+    are set to now, on the instances too, as save() would.
+
+    :param field_names: field names (or attnames) to write
+    :return: number of rows updated
+    """
+    objs = list(objs)
+    if not objs:
+        return 0
+
+    db = router.db_for_write(model)
+    connection = connections[db]
+    qn = connection.ops.quote_name
+
+    opts = model._meta
+    fields = [opts.get_field(name) for name in field_names]
+    fields += [f for f in opts.concrete_fields
+               if getattr(f, 'auto_now', False) and f not in fields]
+
+    now = timezone.now()
+    for obj in objs:
+        for field in fields:
+            if getattr(field, 'auto_now', False):
+                setattr(obj, field.attname, now)
+
+    # Typed placeholders: VALUES columns otherwise come through as text
+    # (rel_db_type for the pk, since a serial isn't a type to cast to)
+    columns = [opts.pk] + fields
+    row_sql = "(" + ", ".join(
+        f"%s::{opts.pk.rel_db_type(connection)}" if f.primary_key
+        else f"%s::{f.db_type(connection)}"
+        for f in columns) + ")"
+    table = qn(opts.db_table)
+
+    def _sql(row_count):
+        return (
+            f"UPDATE {table} SET " +
+            ", ".join(f"{qn(f.column)} = v.{qn(f.column)}" for f in fields) +
+            f" FROM (VALUES {', '.join([row_sql] * row_count)}) "
+            f"AS v ({', '.join(qn(f.column) for f in columns)}) "
+            f"WHERE {table}.{qn(opts.pk.column)} = v.{qn(opts.pk.column)}"
+        )
+
+    updated = 0
+    with transaction.atomic(using=db), connection.cursor() as cursor:
+        for i in range(0, len(objs), batch_size):
+            batch = objs[i:i + batch_size]
+            cursor.execute(_sql(len(batch)), [
+                f.get_db_prep_save(getattr(obj, f.attname), connection)
+                for obj in batch for f in columns
+            ])
+            updated += cursor.rowcount
+
+    return updated
+
+
+def iterate_in_batches(iterable, batch_size):
+    """Yield lists of up to batch_size items, consuming iterable lazily"""
+    iterator = iter(iterable)
+    batch = list(islice(iterator, batch_size))
+
+    while batch:
+        yield batch
+        batch = list(islice(iterator, batch_size))
+
+
+def imap_with_process_pool(func, iterable, workers):
+    """
+    Yield func(item) for each item, as completed, from a pool of
+    worker processes. Django connections are closed before the pool
+    forks so each worker opens its own ('default' and 'cache' alike)
+    rather than sharing the parent's sockets.
+    """
+    connections.close_all()
+
+    with Pool(processes=workers) as pool:
+        for result in pool.imap_unordered(func, iterable):
+            yield result
+
+
+def encode_cursor(*values):
+    """Opaque keyset cursor for the values of the last row served"""
+    raw = ":".join(str(value) for value in values)
+    return urlsafe_b64encode(raw.encode('utf8')).decode('ascii')
+
+
+def decode_cursor(cursor, count):
+    """
+    Inverse of encode_cursor: returns its count values as strings.
+    Raises ValueError for anything it didn't produce.
+    """
+    try:
+        values = urlsafe_b64decode(cursor.encode('ascii')).decode('utf8')\
+            .split(':')
+    except (TypeError, UnicodeError, ValueError) as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+
+    if len(values) != count:
+        raise ValueError(f"Invalid cursor: {cursor}")
+    return values
+
+
+def encode_delta_cursor(sort_date, delta_id):
+    """Cursor for the delta feed row (sort_date, delta_id)"""
+    return encode_cursor(sort_date.isoformat(), delta_id)
+
+
+def decode_delta_cursor(cursor):
+    """Inverse of encode_delta_cursor: returns (sort_date, delta_id)"""
+    sort_date, delta_id = decode_cursor(cursor, 2)
+    return datetime.strptime(sort_date, '%Y-%m-%d').date(), int(delta_id)
+
+
+API_CACHE_GENERATION_KEY = 'api-generation'
+
+
+def _api_cache_generation_keys(user_profile_id):
+    return (API_CACHE_GENERATION_KEY,
+            f"{API_CACHE_GENERATION_KEY}:{user_profile_id}")
+
+
+def _new_api_cache_generation():
+    # Seeded from the clock so a generation lost from the cache never
+    # comes back as one that cached responses were stored under
+    return int(time.time() * 1000)
+
+
+# Backends whose entries live in one process or on one host's disk; a
+# generation bumped there never reaches web workers on other dynos
+_LOCAL_CACHE_BACKENDS = (
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.filebased.FileBasedCache',
+    'django.core.cache.backends.dummy.DummyCache',
+)
+
+
+def api_cache_generation_is_shared():
+    """Whether API cache generations are seen by every process"""
+    return settings.CACHES['default']['BACKEND'] not in _LOCAL_CACHE_BACKENDS
+
+
+def get_api_cache_generation(user_profile_id):
+    """
+    Current 'district.teacher' generation for a profile's cached API
+    responses; bump_api_cache_generation moves either part forward
+    """
+    keys = _api_cache_generation_keys(user_profile_id)
+    generations = cache.get_many(keys)
+
+    for key in keys:
+        if key not in generations:
+            cache.add(key, _new_api_cache_generation(), None)
+            generations[key] = cache.get(key)
+
+    return ".".join(str(generations[key]) for key in keys)
+
+
+def bump_api_cache_generation(user_profile_ids=None):
+    """
+    Invalidate cached API responses for the given profiles, or for
+    every profile when none are given
+    """
+    if user_profile_ids is None:
+        keys = [API_CACHE_GENERATION_KEY]
+    else:
+        keys = [_api_cache_generation_keys(user_profile_id)[1]
+                for user_profile_id in user_profile_ids]
+
+    # Not cache.incr: some backends (eg. FileBasedCache) rewrite the
+    # key with the default timeout, and generations must not expire
+    for key in keys:
+        generation = cache.get(key)
+        cache.set(key,
+                  generation + 1 if generation is not None
+                  else _new_api_cache_generation(),
+                  None)
+
+    return len(keys)
+
+
+def bump_api_cache_generation_for_staff_ids(staff_ids):
+    """bump_api_cache_generation for the profiles of Illuminate staff ids"""
+    return bump_api_cache_generation(
+        UserProfile.objects
+            .filter(sis_id__in=list(staff_ids))
+            .values_list('id', flat=True)
+    )
+
+
 def camel_to_underscore(name):
     """
     See here: http://stackoverflow.com/questions/1175208/elegant-python-function-to-convert-camelcase-to-snake-case
@@ -154,6 +487,7 @@ def manually_roster_with_file(source_file, **kwargs):
                                 user_profile=new_teacher_user_profile,
                                 section=section,
                                 active=True)
+        TeacherStudentAccess.refresh([new_teacher_user_profile.id])
 
 
 def word_hash(length=4):
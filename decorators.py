@@ -1,8 +1,13 @@
 from functools import wraps
+from hashlib import md5
 
-from django.http import JsonResponse
+from django.conf import settings
+from django.core.cache import cache
+from django.http import JsonResponse, HttpResponse
+from django.utils import timezone
 
 from clarify.models import UserProfile
+from clarify_backend.utils import get_api_cache_generation
 
 
 def require_methods(*method_list):
@@ -35,3 +40,66 @@ def requires_user_profile(func):
             }, status=401)
         return func(request, requesting_user_profile, *args, **kwargs)
     return inner
+
+
+def cache_per_user_profile(func):
+    """
+    Caches successful GET responses per requesting profile, view and
+    parameters and day, if they're no larger than API_CACHE_MAX_SIZE.
+    Goes under requires_user_profile; entries are dropped by bumping the
+    profile's generation (see bump_api_cache_generation).
+    """
+
+    @wraps(func)
+    def inner(request, requesting_user_profile, *args, **kwargs):
+        if request.method != 'GET':
+            return func(request, requesting_user_profile, *args, **kwargs)
+
+        params = md5(repr((
+            sorted(request.GET.lists()), args, sorted(kwargs.items())
+        )).encode('utf8')).hexdigest()
+        generation = get_api_cache_generation(requesting_user_profile.id)
+        # Enrollment windows are evaluated against today, so entries
+        # don't carry over into the next day
+        key = f"api:{func.__name__}:{requesting_user_profile.id}:" \
+              f"{generation}:{timezone.now().date().isoformat()}:{params}"
+
+        cached = cache.get(key)
+        if cached is not None:
+            content, content_type = cached
+            return HttpResponse(content, content_type=content_type)
+
+        response = func(request, requesting_user_profile, *args, **kwargs)
+        if response.status_code != 200:
+            return response
+
+        content_type = response['Content-Type']
+        if response.streaming:
+            response.streaming_content = _cache_when_streamed(
+                response.streaming_content, key, content_type)
+        elif len(response.content) <= settings.API_CACHE_MAX_SIZE:
+            cache.set(key, (response.content, content_type),
+                      settings.API_CACHE_TIMEOUT)
+        return response
+    return inner
+
+
+def _cache_when_streamed(chunks, key, content_type):
+    """
+    Pass a streaming response's chunks through, caching the body once
+    it has all been sent if it stayed under API_CACHE_MAX_SIZE
+    """
+    kept = []
+    size = 0
+    for chunk in chunks:
+        if kept is not None:
+            size += len(chunk)
+            if size <= settings.API_CACHE_MAX_SIZE:
+                kept.append(chunk)
+            else:
+                kept = None
+        yield chunk
+
+    if kept is not None:
+        cache.set(key, (b''.join(kept), content_type),
+                  settings.API_CACHE_TIMEOUT)
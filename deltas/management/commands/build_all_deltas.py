@@ -1,5 +1,6 @@
 from django.core.management.base import BaseCommand
 
+from clarify_backend.utils import bump_api_cache_generation
 from deltas.tasks import build_deltas_for_all_current_academic_teachers
 
 
@@ -11,8 +12,16 @@ class Command(BaseCommand):
                             action='store_true',
                             dest='clean')
 
+        parser.add_argument('--workers',
+                            dest='workers',
+                            type=int,
+                            default=1,
+                            help="Number of processes to shard gradebooks over")
+
     def handle(self, *args, **options):
         success_string = build_deltas_for_all_current_academic_teachers(
-            clean=True if options["clean"] else False
+            clean=True if options["clean"] else False,
+            workers=options["workers"]
         )
+        bump_api_cache_generation()
         self.stdout.write(self.style.SUCCESS(success_string))
\ No newline at end of file
@@ -1,6 +1,7 @@
 from django.core.management.base import BaseCommand
 from tqdm import tqdm
 
+from clarify_backend.utils import bump_api_cache_generation_for_staff_ids
 from sis_mirror.models import Users
 
 from deltas.tasks import (
@@ -29,6 +30,8 @@ class Command(BaseCommand):
             total_cat += new_cat
             total_mis += new_mis
 
+        bump_api_cache_generation_for_staff_ids(staff_ids)
+
         n = len(staff_ids)
 
         self.stdout.write(self.style.SUCCESS(
@@ -1,7 +1,9 @@
 from django.core.management.base import BaseCommand
 
+from clarify_backend.utils import bump_api_cache_generation
 from deltas.models import (
-    Delta, CategoryGradeContextRecord, MissingAssignmentRecord
+    Delta, CategoryGradeContextRecord, MissingAssignmentRecord,
+    CategoryRunningTotal
 )
 
 
@@ -29,10 +31,13 @@ class Command(BaseCommand):
 
         if all_types or 'category' in selected_types:
             CategoryGradeContextRecord.objects.all().delete()
+            CategoryRunningTotal.objects.all().delete()
 
         if all_types or 'missing' in selected_types:
             MissingAssignmentRecord.objects.all().delete()
 
+        bump_api_cache_generation()
+
         selected_string = "" if len(selected_types) == 0\
             else f"{', '.join(selected_types)} "
 
@@ -0,0 +1,54 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from deltas.tasks import process_category_delta_queue
+
+
+class Command(BaseCommand):
+    help = "Rebuild category deltas for queued (student, category) pairs."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size',
+                            dest='batch_size',
+                            type=int,
+                            default=500)
+
+        parser.add_argument('--loop',
+                            action='store_true',
+                            dest='loop',
+                            help="Keep polling the queue instead of "
+                                 "exiting once it's empty")
+
+        parser.add_argument('--sleep',
+                            dest='sleep',
+                            type=int,
+                            default=30,
+                            help="Seconds to wait on an empty queue "
+                                 "with --loop")
+
+    def handle(self, *args, **options):
+        total_pairs = 0
+        total_deltas = 0
+
+        while True:
+            pairs, new_deltas = process_category_delta_queue(
+                batch_size=options["batch_size"])
+
+            total_pairs += pairs
+            total_deltas += new_deltas
+
+            if pairs:
+                self.stdout.write(
+                    f"\t{pairs} pairs processed, {new_deltas} new deltas")
+                continue
+
+            if not options["loop"]:
+                break
+
+            time.sleep(options["sleep"])
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Queue drained: {total_pairs} pairs processed | "
+            f"New category deltas: {total_deltas}"
+        ))
@@ -1,6 +1,7 @@
 from django.core.management.base import BaseCommand
 from tqdm import tqdm
 
+from clarify_backend.utils import bump_api_cache_generation
 from deltas.models import Delta
 
 
@@ -20,6 +21,8 @@ class Command(BaseCommand):
             delta.gradebook_id = gradebook_id
             delta.save()
 
+        bump_api_cache_generation()
+
         success_string = f'Completed update on {len(deltas)} delta' + \
                          f'{"" if len(deltas) == 1 else "s"}'
 
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.12 on 2019-02-14 17:40
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('clarify', '0031_gradebook_scores_synced_through'),
+        ('deltas', '0002_auto_20190205_2120'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QueuedCategoryDelta',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('queued_on', models.DateTimeField(default=django.utils.timezone.now)),
+                ('category', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='clarify.Category')),
+                ('student', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='clarify.Student')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='queuedcategorydelta',
+            unique_together=set([('student', 'category')]),
+        ),
+    ]
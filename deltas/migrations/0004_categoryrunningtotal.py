@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.12 on 2019-02-15 16:25
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('clarify', '0031_gradebook_scores_synced_through'),
+        ('deltas', '0003_queuedcategorydelta'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CategoryRunningTotal',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('points_earned', models.FloatField(default=0)),
+                ('possible_points', models.FloatField(default=0)),
+                ('score_count', models.IntegerField(default=0)),
+                ('last_due_date', models.DateField()),
+                ('updated_on', models.DateTimeField(auto_now=True)),
+                ('category', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='clarify.Category')),
+                ('student', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='clarify.Student')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='categoryrunningtotal',
+            unique_together=set([('student', 'category')]),
+        ),
+    ]
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.12 on 2019-02-18 10:12
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+from django.db.models.functions import TruncDate
+import django.utils.timezone
+
+
+def backfill_sort_date(apps, schema_editor):
+    Delta = apps.get_model('deltas', 'Delta')
+    Score = apps.get_model('clarify', 'Score')
+
+    Delta.objects.update(sort_date=TruncDate('created_on'))
+
+    due_dates = (Score.objects
+                 .filter(id=OuterRef('score_id'))
+                 .values('assignment__due_date')[:1])
+
+    (Delta.objects
+        .filter(type='category', score__assignment__due_date__isnull=False)
+        .update(sort_date=Subquery(due_dates)))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('clarify', '0031_gradebook_scores_synced_through'),
+        ('deltas', '0004_categoryrunningtotal'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='delta',
+            name='sort_date',
+            field=models.DateField(default=django.utils.timezone.now),
+        ),
+        migrations.AddIndex(
+            model_name='delta',
+            index=models.Index(fields=['-sort_date', '-id'], name='deltas_delt_sort_da_267601_idx'),
+        ),
+        migrations.RunPython(backfill_sort_date, migrations.RunPython.noop),
+    ]
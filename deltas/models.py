@@ -1,8 +1,9 @@
 from django.db import models
+from django.db.models import Q
 from django.utils import timezone
 
 from clarify.models import Student, Assignment, Category, Score, UserProfile, \
-    Gradebook, Score
+    Gradebook, Score, TeacherStudentAccess
 from sis_mirror.models import Gradebooks
 
 """
@@ -63,6 +64,15 @@ class Delta(models.Model):
     # attendance field
     settled = models.BooleanField(default=False)
 
+    # feed ordering: the score's due date for category deltas,
+    # the creation date otherwise
+    sort_date = models.DateField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['-sort_date', '-id']),
+        ]
+
     def __str__(self):
         out_string = f"{self.student.id}: {self.type}"
         if self.type == self.CATEGORY:
@@ -75,8 +85,40 @@ class Delta(models.Model):
 
         return out_string
 
+    RESPONSE_FIELDS = [
+        'id', 'student_id', 'created_on', 'updated_on', 'type',
+        'gradebook_id', 'gradebook__name', 'sort_date',
+    ]
+
+    CATEGORY_RESPONSE_FIELDS = [
+        'score_id',
+        'score__score',
+        'score__last_updated',
+        'score__assignment_id',
+        'score__assignment__name',
+        'score__assignment__possible_points',
+        'score__assignment__due_date',
+        'context_record__category_id',
+        'context_record__category__name',
+        'context_record__date',
+        'context_record__total_points_possible',
+        'context_record__average_points_earned',
+        'category_average_before',
+        'category_average_after',
+    ]
+
     @classmethod
-    def return_response_query(cls, profile_id, student_id=None, delta_type=None):
+    def return_response_query(cls, profile_id, student_id=None, delta_type=None,
+                              since=None, after=None):
+        """
+        Flat values() rows for the delta feed, joined to the gradebook,
+        score, assignment and context record columns the response uses;
+        missing assignments come from get_missing_records_for_delta_ids.
+
+        Rows are newest first on (sort_date, id). since limits them to
+        sort dates on or after it, and after=(sort_date, id) resumes
+        below a row already served.
+        """
         gradebook_ids = Gradebook\
             .get_all_current_gradebook_ids_for_user_profile(profile_id)
 
@@ -90,39 +132,81 @@ class Delta(models.Model):
         if student_id:
             filters = {'student_id': student_id}
 
-        sections_for_profile = "__".join([
-            "student",
-            "enrollmentrecord",
-            "section",
-            "staffsectionrecord",
-            "user_profile_id"
-        ])
+        # Resolved as one semi-join instead of joining every enrollment
+        # and staff record onto each delta and de-duplicating with DISTINCT
+        student_ids = TeacherStudentAccess\
+            .get_student_ids_for_user_profile(profile_id)
 
-        queryset = (
+        if since:
+            filters['sort_date__gte'] = since
+
+        keyset = Q()
+        if after:
+            after_sort_date, after_id = after
+            keyset = (Q(sort_date__lt=after_sort_date) |
+                      Q(sort_date=after_sort_date, id__lt=after_id))
+
+        fields = list(cls.RESPONSE_FIELDS)
+        if filters.get('type') != cls.MISSING:
+            fields += cls.CATEGORY_RESPONSE_FIELDS
+
+        return (
             cls.objects
-                .filter(**{sections_for_profile: profile_id})
-                .order_by('student_id', '-id')
+                .filter(student_id__in=student_ids)
+                .filter(keyset, **filters)
+                .order_by('-sort_date', '-id')
+                .values(*fields)
         )
 
-        prefetch_list = ['gradebook']
-
-        if delta_type == "missing" or not delta_type:
-            prefetch_list += [
-                "missingassignmentrecord_set",
-                "missingassignmentrecord_set__assignment"
-            ]
-
-        if delta_type == "category" or not delta_type:
-            prefetch_list += [
-                "score__assignment",
-                "context_record",
-                "context_record__category"
-            ]
-        return (queryset
-                    .filter(**filters)
-                    .prefetch_related(*prefetch_list)
-                    .distinct()
-                    .all())
+    @classmethod
+    def get_missing_records_for_delta_ids(cls, delta_ids):
+        """Returns {delta_id: [missing assignment record values]}"""
+        records = (
+            MissingAssignmentRecord.objects
+                .filter(delta_id__in=delta_ids)
+                .order_by('id')
+                .values('delta_id', 'assignment_id', 'assignment__name',
+                        'assignment__due_date', 'assignment__possible_points',
+                        'missing_on')
+        )
+
+        records_by_delta_id = {}
+        for record in records:
+            records_by_delta_id.setdefault(record['delta_id'], []).append(record)
+        return records_by_delta_id
+
+
+class CategoryRunningTotal(models.Model):
+    """
+    A student's running category totals through last_due_date, so
+    delta building folds in only later scores instead of re-adding
+    the category's history
+    """
+    student = models.ForeignKey(Student)
+    category = models.ForeignKey(Category)
+
+    points_earned = models.FloatField(default=0)
+    possible_points = models.FloatField(default=0)
+    score_count = models.IntegerField(default=0)
+    last_due_date = models.DateField()
+
+    updated_on = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('student', 'category')
+
+
+class QueuedCategoryDelta(models.Model):
+    """
+    (student, category) pairs whose scores changed since their
+    category deltas were last built; drained by process_delta_queue
+    """
+    student = models.ForeignKey(Student)
+    category = models.ForeignKey(Category)
+    queued_on = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        unique_together = ('student', 'category')
 
 
 class MissingAssignmentRecord(models.Model):
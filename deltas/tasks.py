@@ -1,5 +1,6 @@
 from datetime import datetime
-from django.db import IntegrityError
+import numpy as np
+from django.db import IntegrityError, transaction, connection
 from django.db.models import Sum, F, Avg, Max, Q, IntegerField, When, \
     Case, Count, FloatField, QuerySet
 from django.utils import timezone
@@ -7,10 +8,21 @@ from pprint import pprint
 from tqdm import tqdm
 
 from clarify.models import Score, Assignment, Gradebook, Category
+from clarify_backend.utils import (
+    upsert_or_skip_errors,
+    imap_with_process_pool,
+    bump_api_cache_generation
+)
 from sis_mirror.models import (
     ScoreCache,
     Users)
-from .models import Delta, MissingAssignmentRecord, CategoryGradeContextRecord
+from .models import (
+    Delta,
+    MissingAssignmentRecord,
+    CategoryGradeContextRecord,
+    CategoryRunningTotal,
+    QueuedCategoryDelta
+)
 
 tqdm.monitor_interval = 0
 
@@ -122,34 +134,6 @@ def get_scores_until_date_for_student(student_id, gradebook_id, date):
     )
 
 
-def get_all_missing_for_user(user_id, grading_period_id=None):
-    """
-    Get all missing assignments for a teacher and gradebook
-    Defaults to most recent active grading period.
-    :param user_id: Illuminate user id
-    """
-
-    gradebooks = Gradebook\
-        .get_all_current_gradebook_ids_for_user_profile(user_id)
-
-    missing = []
-
-    for gradebook_id in tqdm(gradebooks,
-                          desc="Gradebooks",
-                          leave=False):
-        missing += get_missing_for_gradebook(gradebook_id)
-
-    student_dict = {}
-
-    for missing_assignment in missing:
-        student_id = missing_assignment["student_id"]
-        if student_id not in student_dict:
-            student_dict[student_id] = []
-        student_dict[student_id].append(missing_assignment)
-
-    return student_dict
-
-
 def delta_threshold_test(score: Score, running_score_dict):
     """
     Threshold test for creating a delta
@@ -183,7 +167,51 @@ def delta_threshold_test(score: Score, running_score_dict):
     return False
 
 
+def get_or_create_category_context_record(category_id, score: Score):
+    """
+    Class-wide category totals as of the score's due date
+    :return: CategoryGradeContextRecord
+    """
+    category_context = (
+        CategoryGradeContextRecord.objects
+        .filter(
+            date=score.assignment.due_date,
+            category_id=category_id
+        ).first()
+    )
+
+    if category_context:
+        return category_context
+
+    data = calculate_category_scores_until_date_or_score(
+        category_id_or_ids=category_id, score=score)[0]
+    total_points_possible = (
+            data["possible_points"] / data["score_count"])
+    average_points_earned = (
+            data["points_earned"] / data["score_count"])
+    date = data["latest_due_date"]
+
+    try:
+        return (
+            CategoryGradeContextRecord.objects.get_or_create(
+                total_points_possible=total_points_possible,
+                average_points_earned=average_points_earned,
+                category_id=category_id,
+                date=date
+            )[0]
+        )
+    except Exception as e:
+        pprint(data)
+        raise e
+
+
 def build_deltas_for_student_and_category(student_id, category_id):
+    checkpoint = (
+        CategoryRunningTotal.objects
+        .filter(student_id=student_id, category_id=category_id)
+        .first()
+    )
+
     latest_delta = (
         Delta.objects
         .filter(type="category",
@@ -200,7 +228,9 @@ def build_deltas_for_student_and_category(student_id, category_id):
         'assignment__category_id': category_id
     }
 
-    if latest_delta:
+    if checkpoint:
+        scores_filter["assignment__due_date__gt"] = checkpoint.last_due_date
+    elif latest_delta:
         scores_filter["assignment__due_date__gte"] = (
             latest_delta.score.assignment.due_date
         )
@@ -217,7 +247,15 @@ def build_deltas_for_student_and_category(student_id, category_id):
         .all()
     )
 
-    if latest_delta:
+    if checkpoint:
+        running_total = {
+            'points_earned': checkpoint.points_earned,
+            'possible_points': checkpoint.possible_points
+        }
+        score_count = checkpoint.score_count
+        last_due_date = checkpoint.last_due_date
+
+    elif latest_delta:
         try:
             up_to_date = \
                     calculate_category_scores_until_date_or_score(
@@ -226,6 +264,8 @@ def build_deltas_for_student_and_category(student_id, category_id):
                 'points_earned': up_to_date["points_earned"],
                 'possible_points': up_to_date["possible_points"]
             }
+            score_count = up_to_date["score_count"]
+            last_due_date = None
         except IndexError as e:
             import pdb; pdb.set_trace()
             raise e
@@ -235,8 +275,11 @@ def build_deltas_for_student_and_category(student_id, category_id):
             'points_earned': 0.0,
             'possible_points': 0.0
         }
+        score_count = 0
+        last_due_date = None
 
     new_deltas = 0
+    folded = 0
 
     for score in scores_list:
 
@@ -259,36 +302,8 @@ def build_deltas_for_student_and_category(student_id, category_id):
 
         if running_total["possible_points"] == 0 or \
            delta_threshold_test(score, running_total):
-            category_context = (
-                CategoryGradeContextRecord.objects
-                .filter(
-                    date=score.assignment.due_date,
-                    category_id=category_id
-                ).first()
-            )
-
-            if not category_context:
-
-                data = calculate_category_scores_until_date_or_score(
-                    category_id_or_ids=category_id, score=score)[0]
-                total_points_possible = (
-                        data["possible_points"] / data["score_count"])
-                average_points_earned = (
-                        data["points_earned"] / data["score_count"])
-                date = data["latest_due_date"]
-
-                try:
-                    category_context = (
-                        CategoryGradeContextRecord.objects.get_or_create(
-                            total_points_possible=total_points_possible,
-                            average_points_earned=average_points_earned,
-                            category_id=category_id,
-                            date=date
-                        )[0]
-                    )
-                except Exception as e:
-                    pprint(data)
-                    raise e
+            category_context = get_or_create_category_context_record(
+                category_id, score)
 
             try:
                 category_average_before = 0 if possible_points == 0 \
@@ -313,7 +328,8 @@ def build_deltas_for_student_and_category(student_id, category_id):
                 score=score,
                 gradebook_id=score.assignment.gradebook_id,
                 category_average_before=category_average_before,
-                category_average_after=category_average_after
+                category_average_after=category_average_after,
+                sort_date=score.assignment.due_date or timezone.now()
             )
 
             new_deltas += 1
@@ -322,10 +338,342 @@ def build_deltas_for_student_and_category(student_id, category_id):
 
         running_total['points_earned'] += score.points
         running_total['possible_points'] += score.assignment.possible_points
+        score_count += 1
+        last_due_date = score.assignment.due_date or last_due_date
+        folded += 1
+
+    if folded and last_due_date:
+        CategoryRunningTotal.objects.update_or_create(
+            student_id=student_id,
+            category_id=category_id,
+            defaults={
+                **running_total,
+                'score_count': score_count,
+                'last_due_date': last_due_date
+            }
+        )
 
     return new_deltas
 
 
+def _grouped_exclusive_cumsum(values, group_starts):
+    """
+    Running sum of values before each row, restarting at each group
+    :param group_starts: bool array, True on the first row of each group
+    """
+    totals = np.cumsum(values)
+    before = totals - values
+    start_index = np.maximum.accumulate(
+        np.where(group_starts, np.arange(len(values)), 0))
+
+    return before - before[start_index]
+
+
+def build_category_deltas_for_gradebook(gradebook_id):
+    """
+    Category deltas for every student and category in a gradebook, in
+    one pass over columnar score arrays. Same rules as
+    build_deltas_for_student_and_category: scores are walked in due
+    date order from the pair's CategoryRunningTotal (or else its latest
+    category delta), and a delta fires when the category is empty so
+    far or delta_threshold_test would pass. Checkpoints are moved
+    forward to the last score folded in.
+    :return: number of new deltas
+    """
+    rows = list(
+        Score.objects
+        .filter(assignment__gradebook_id=gradebook_id,
+                assignment__category_id__isnull=False)
+        .values_list('id', 'student_id', 'assignment__category_id',
+                     'assignment__due_date', 'points', 'score',
+                     'assignment__possible_points', 'is_excused',
+                     'assignment__is_active')
+    )
+
+    if not rows:
+        return 0
+
+    (score_id, student_id, category_id, due_date, points, score,
+     possible, is_excused, is_active) = zip(*rows)
+
+    score_id = np.array(score_id)
+    student_id = np.array(student_id)
+    category_id = np.array(category_id)
+    due_date = np.array(due_date, dtype='datetime64[D]')
+    points = np.array(points, dtype=float)
+    score = np.array(score, dtype=float)
+    possible = np.array(possible, dtype=float)
+    is_excused = np.array(is_excused, dtype=bool)
+    # is_active is nullable: only True counts toward totals, but
+    # only False keeps a score from being tested
+    is_inactive = np.array([a is False for a in is_active])
+    is_active = np.array([a is True for a in is_active])
+    has_due_date = ~np.isnat(due_date)
+
+    # Scores that already have a delta, and each (category, student)'s
+    # latest delta due date, which is where its running total resumes
+    delta_rows = list(
+        Delta.objects
+        .filter(type=Delta.CATEGORY,
+                score__assignment__gradebook_id=gradebook_id)
+        .values_list('score_id', 'student_id',
+                     'score__assignment__category_id',
+                     'score__assignment__due_date')
+    )
+    has_delta = np.isin(score_id, [r[0] for r in delta_rows])
+
+    pairs, group = np.unique(np.stack([category_id, student_id], axis=1),
+                             axis=0, return_inverse=True)
+    group_index = {tuple(pair): i for i, pair in enumerate(pairs.tolist())}
+
+    latest_delta_dates = {}
+    earliest = datetime.min.date()
+    for _, delta_student, delta_category, delta_due in delta_rows:
+        key = (delta_category, delta_student)
+        if delta_due and delta_due > latest_delta_dates.get(key, earliest):
+            latest_delta_dates[key] = delta_due
+
+    resume_date = np.full(len(pairs), np.datetime64('NaT'),
+                          dtype='datetime64[D]')
+    for key, delta_due in latest_delta_dates.items():
+        if key in group_index:
+            resume_date[group_index[key]] = delta_due
+
+    graded = ~is_excused & has_due_date & ~np.isnan(points)
+
+    # Totals up to and including the latest delta's due date
+    row_resume = resume_date[group]
+    resumed = ~np.isnat(row_resume)
+    before_resume = (graded & is_active & resumed &
+                     (due_date <= row_resume))
+    start_earned = np.bincount(group[before_resume],
+                               weights=points[before_resume],
+                               minlength=len(pairs))
+    start_possible = np.bincount(
+        group[before_resume],
+        weights=np.nan_to_num(possible[before_resume]),
+        minlength=len(pairs))
+    start_count = np.bincount(group[before_resume], minlength=len(pairs))
+
+    # Pairs with a checkpoint resume from its totals instead, and only
+    # fold in scores due after it
+    has_checkpoint = np.zeros(len(pairs), dtype=bool)
+    checkpoint_date = np.full(len(pairs), np.datetime64('NaT'),
+                              dtype='datetime64[D]')
+    for (checkpoint_category, checkpoint_student, checkpoint_earned,
+         checkpoint_possible, checkpoint_count, checkpoint_due) in (
+            CategoryRunningTotal.objects
+            .filter(category__gradebook_id=gradebook_id)
+            .values_list('category_id', 'student_id', 'points_earned',
+                         'possible_points', 'score_count',
+                         'last_due_date')):
+        i = group_index.get((checkpoint_category, checkpoint_student))
+        if i is None:
+            continue
+        has_checkpoint[i] = True
+        checkpoint_date[i] = checkpoint_due
+        start_earned[i] = checkpoint_earned
+        start_possible[i] = checkpoint_possible
+        start_count[i] = checkpoint_count
+
+    row_checkpointed = has_checkpoint[group]
+    resumes_here = np.where(row_checkpointed,
+                            due_date > checkpoint_date[group],
+                            ~resumed | (due_date >= row_resume))
+
+    candidate = (graded & ~is_inactive & ~np.isnan(possible) & ~has_delta &
+                 resumes_here)
+    order = np.flatnonzero(candidate)
+    order = order[np.lexsort((score_id[order], due_date[order],
+                              group[order]))]
+
+    if not len(order):
+        return 0
+
+    c_group = group[order]
+    c_points = points[order]
+    c_possible = possible[order]
+    group_starts = np.r_[True, c_group[1:] != c_group[:-1]]
+
+    before_earned = (start_earned[c_group] +
+                     _grouped_exclusive_cumsum(c_points, group_starts))
+    before_possible = (start_possible[c_group] +
+                       _grouped_exclusive_cumsum(c_possible, group_starts))
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        average_before = np.where(before_possible == 0, 0,
+                                  before_earned / before_possible)
+        # delta_threshold_test measures the change with the raw score
+        test_after = ((before_earned + np.nan_to_num(score[order])) /
+                      (before_possible + c_possible))
+        after_possible = before_possible + c_possible
+        average_after = np.where(after_possible == 0, 0,
+                                 (before_earned + c_points) / after_possible)
+
+        fires = (before_possible == 0) | \
+            (np.abs(test_after - average_before) > 0.1)
+
+    # New checkpoint for each pair: totals after its last candidate
+    group_ends = np.r_[c_group[1:] != c_group[:-1], True]
+    end_groups = c_group[group_ends]
+    end_counts = (start_count[end_groups] +
+                  np.bincount(c_group, minlength=len(pairs))[end_groups])
+
+    checkpoints = [
+        {'category_id': c,
+         'student_id': st,
+         'points_earned': earned,
+         'possible_points': possible_points,
+         'score_count': count,
+         'last_due_date': last_due_date}
+        for (c, st), earned, possible_points, count, last_due_date in zip(
+            pairs[end_groups].tolist(),
+            (before_earned + c_points)[group_ends].tolist(),
+            (before_possible + c_possible)[group_ends].tolist(),
+            end_counts.tolist(),
+            due_date[order][group_ends].astype(object).tolist()
+        )
+    ]
+
+    fired = order[fires]
+
+    context_ids = get_category_context_record_ids(
+        set(zip(category_id[fired].tolist(),
+                due_date[fired].astype(object).tolist()))
+    ) if len(fired) else {}
+
+    new_deltas = [
+        Delta(type=Delta.CATEGORY,
+              student_id=d_student,
+              context_record_id=context_ids.get((d_category, d_due)),
+              score_id=d_score,
+              gradebook_id=gradebook_id,
+              category_average_before=d_before,
+              category_average_after=d_after,
+              sort_date=d_due)
+        for d_score, d_student, d_category, d_due, d_before, d_after in zip(
+            score_id[fired].tolist(),
+            student_id[fired].tolist(),
+            category_id[fired].tolist(),
+            due_date[fired].astype(object).tolist(),
+            average_before[fires].tolist(),
+            average_after[fires].tolist()
+        )
+    ]
+
+    with transaction.atomic():
+        Delta.objects.bulk_create(new_deltas, batch_size=1000)
+        upsert_or_skip_errors(CategoryRunningTotal, checkpoints,
+                              ('student_id', 'category_id'))
+
+    return len(new_deltas)
+
+
+def materialize_category_context_records(category_ids=None):
+    """
+    Compute CategoryGradeContextRecords for every (category, due date)
+    in one grouped pass: per-date totals of active, unexcused scores,
+    accumulated over due dates with a window, then upserted.
+    :param category_ids: optional list; defaults to all categories
+    :return: number of new records
+    """
+    category_filter = ""
+    params = []
+    if category_ids is not None:
+        category_filter = "AND a.category_id = ANY(%s)"
+        params.append(list(category_ids))
+
+    query = f"""
+        WITH by_date AS (
+            SELECT a.category_id,
+                   a.due_date,
+                   COUNT(*) AS score_count,
+                   COALESCE(SUM(s.points), 0) AS points_earned,
+                   COALESCE(SUM(CASE WHEN s.points IS NULL THEN NULL
+                                     ELSE a.possible_points END), 0)
+                       AS possible_points
+            FROM {Score._meta.db_table} s
+            JOIN {Assignment._meta.db_table} a ON a.id = s.assignment_id
+            WHERE a.is_active
+              AND NOT s.is_excused
+              AND a.due_date IS NOT NULL
+              AND a.category_id IS NOT NULL
+              {category_filter}
+            GROUP BY a.category_id, a.due_date
+        )
+        SELECT category_id,
+               due_date,
+               SUM(possible_points) OVER w / SUM(score_count) OVER w,
+               SUM(points_earned) OVER w / SUM(score_count) OVER w
+        FROM by_date
+        WINDOW w AS (PARTITION BY category_id ORDER BY due_date)
+    """
+
+    with connection.cursor() as cursor:
+        cursor.execute(query, params)
+        records = [
+            {'category_id': category_id,
+             'date': due_date,
+             'total_points_possible': total_points_possible,
+             'average_points_earned': average_points_earned}
+            for category_id, due_date, total_points_possible,
+            average_points_earned in cursor.fetchall()
+        ]
+
+    new, _, _ = upsert_or_skip_errors(
+        CategoryGradeContextRecord, records, ('category_id', 'date'))
+
+    return new
+
+
+def get_category_context_record_ids(keys):
+    """
+    Look up CategoryGradeContextRecords for (category_id, date) keys,
+    materializing the categories of any that don't exist yet.
+
+    Only active assignments' dates are materialized, so a date with
+    none (eg. a NULL is_active) gets the category's latest record on or
+    before it, the same totals get_or_create_category_context_record
+    would land on; keys with no earlier record are left out.
+    :return: { (category_id, date): record id }
+    """
+
+    def _records(category_ids):
+        records = {}
+        for c, d, record_id in (CategoryGradeContextRecord.objects
+                                .filter(category_id__in=category_ids)
+                                .order_by('date')
+                                .values_list('category_id', 'date', 'id')):
+            records.setdefault(c, []).append((d, record_id))
+        return records
+
+    def _lookup(category_ids):
+        return {
+            (c, d): record_id
+            for c, dates in _records(category_ids).items()
+            for d, record_id in dates
+            if (c, d) in keys
+        }
+
+    context_ids = _lookup({c for c, _ in keys})
+
+    missing_category_ids = {c for c, _ in keys - set(context_ids)}
+    if missing_category_ids:
+        materialize_category_context_records(list(missing_category_ids))
+        context_ids.update(_lookup(missing_category_ids))
+
+    missing_keys = keys - set(context_ids)
+    if missing_keys:
+        records = _records({c for c, _ in missing_keys})
+        for c, d in missing_keys:
+            earlier = [record_id for record_date, record_id
+                       in records.get(c, []) if record_date <= d]
+            if earlier:
+                context_ids[(c, d)] = earlier[-1]
+
+    return context_ids
+
+
 def build_deltas_for_category(category_id):
     student_ids = (
         Score.objects
@@ -346,16 +694,7 @@ def build_deltas_for_category(category_id):
 
 
 def build_deltas_for_gradebook(gradebook_id):
-    category_ids = (Category.objects
-                    .filter(gradebook_id=gradebook_id)
-                    .values_list('id', flat=True))
-
-    new_deltas = 0
-
-    for category_id in tqdm(category_ids, desc="Categories", leave=False):
-        new_deltas += build_deltas_for_category(category_id)
-
-    return new_deltas
+    return build_category_deltas_for_gradebook(gradebook_id)
 
 
 def build_deltas_for_staff_current_gradebooks(staff_id):
@@ -380,97 +719,240 @@ def build_deltas_for_staff_current_gradebooks(staff_id):
 """
 
 
-def build_missing_assignment_deltas_for_user(user_id, grading_period_id=None):
+def build_missing_assignment_deltas_for_user(user_id):
+    gradebook_ids = Gradebook\
+        .get_all_current_gradebook_ids_for_user_profile(user_id)
+
+    return build_missing_assignment_deltas_for_gradebooks(list(gradebook_ids))
+
+
+def build_missing_assignment_deltas_for_gradebook(gradebook_id):
+    return build_missing_assignment_deltas_for_gradebooks([gradebook_id])
+
+
+def build_missing_assignment_deltas_for_gradebooks(gradebook_ids):
+    """
+    One missing delta per (student, gradebook) whose set of missing
+    assignments differs from the one on its latest missing delta.
+    Reads all missing scores and all latest delta signatures in two
+    queries, and writes the new deltas and records in bulk.
+    :return: new deltas, errors
+    """
+
+    # { (student_id, gradebook_id): { assignment_id } }
+    missing_sets = {}
+    for student_id, gradebook_id, assignment_id in (
+            Score.objects
+            .filter(assignment__gradebook_id__in=gradebook_ids,
+                    is_missing=True)
+            .values_list('student_id', 'assignment__gradebook_id',
+                         'assignment_id')):
+        missing_sets.setdefault((student_id, gradebook_id), set()).add(
+            assignment_id)
+
+    if not missing_sets:
+        return 0, 0
 
-    # get all missing assignments by student
-    all_missing = get_all_missing_for_user(user_id, grading_period_id)
+    latest_delta_ids = (
+        Delta.objects
+        .filter(type=Delta.MISSING, gradebook_id__in=gradebook_ids)
+        .order_by('student_id', 'gradebook_id', '-updated_on', '-id')
+        .distinct('student_id', 'gradebook_id')
+        .values('id')
+    )
 
-    new_deltas_created = 0
-    errors = 0
+    latest_sets = {}
+    for student_id, gradebook_id, assignment_id in (
+            MissingAssignmentRecord.objects
+            .filter(delta_id__in=latest_delta_ids)
+            .values_list('delta__student_id', 'delta__gradebook_id',
+                         'assignment_id')):
+        latest_sets.setdefault((student_id, gradebook_id), set()).add(
+            assignment_id)
+
+    changed = [
+        (key, assignment_ids) for key, assignment_ids in missing_sets.items()
+        if latest_sets.get(key) != assignment_ids
+    ]
+
+    if not changed:
+        return 0, 0
+
+    missing_on = timezone.now().date()
+
+    try:
+        with transaction.atomic():
+            new_deltas = Delta.objects.bulk_create([
+                Delta(type=Delta.MISSING,
+                      student_id=student_id,
+                      gradebook_id=gradebook_id)
+                for (student_id, gradebook_id), _ in changed
+            ], batch_size=1000)
+
+            MissingAssignmentRecord.objects.bulk_create([
+                MissingAssignmentRecord(delta_id=delta.id,
+                                        assignment_id=assignment_id,
+                                        missing_on=missing_on)
+                for delta, (_, assignment_ids) in zip(new_deltas, changed)
+                for assignment_id in assignment_ids
+            ], batch_size=1000)
+    except IntegrityError as e:
+        print(f"Error creating missing deltas: {e}")
+        return 0, len(changed)
+
+    return len(new_deltas), 0
+
+
+def queue_category_deltas_for_score_ids(score_ids):
+    """
+    Queue the (student, category) pairs of changed scores for
+    process_category_delta_queue. A changed score due on or before its
+    pair's checkpoint invalidates the checkpoint, since the stored
+    totals no longer add up.
+    :return: number of newly queued pairs
+    """
+    changed = list(
+        Score.objects
+        .filter(id__in=list(score_ids),
+                assignment__category_id__isnull=False)
+        .values_list('student_id', 'assignment__category_id',
+                     'assignment__due_date')
+    )
 
-    for student_id, missing_assignments in tqdm(all_missing.items(),
-                                                    desc="Students",
-                                                    leave=False):
+    # { (student_id, category_id): earliest changed due date or None }
+    pairs = {}
+    for student_id, category_id, due_date in changed:
+        key = (student_id, category_id)
+        if key not in pairs:
+            pairs[key] = due_date
+        elif pairs[key] is not None:
+            pairs[key] = None if due_date is None \
+                else min(pairs[key], due_date)
+
+    if not pairs:
+        return 0
+
+    stale_checkpoint_ids = [
+        checkpoint_id for checkpoint_id, student_id, category_id, last_due_date
+        in CategoryRunningTotal.objects
+        .filter(student_id__in={s for s, _ in pairs},
+                category_id__in={c for _, c in pairs})
+        .values_list('id', 'student_id', 'category_id', 'last_due_date')
+        if (student_id, category_id) in pairs and (
+            pairs[(student_id, category_id)] is None or
+            pairs[(student_id, category_id)] <= last_due_date)
+    ]
+    CategoryRunningTotal.objects.filter(id__in=stale_checkpoint_ids).delete()
+
+    queued_on = timezone.now()
+
+    new, _, _ = upsert_or_skip_errors(QueuedCategoryDelta, [
+        {'student_id': student_id,
+         'category_id': category_id,
+         'queued_on': queued_on}
+        for student_id, category_id in pairs
+    ], ('student_id', 'category_id'))
+
+    return new
+
+
+def process_category_delta_queue(batch_size=500):
+    """
+    Rebuild category deltas for one batch of queued (student, category)
+    pairs, oldest first. Rows are locked with SKIP LOCKED, so several
+    workers can drain the queue at once, and a pair re-queued by a sync
+    mid-batch waits for the batch and is queued again after it.
+    :return: pairs processed, new deltas
+    """
+    new_deltas = 0
 
-        last_missing_delta_for_student = (
-            Delta.objects
-            .filter(student_id=student_id,
-                    type="missing",
-                    gradebook_id=missing_assignments[0]["gradebook_id"])
-            .order_by('-updated_on')
-            .first()
+    with transaction.atomic():
+        queued = list(
+            QueuedCategoryDelta.objects
+            .select_for_update(skip_locked=True)
+            .order_by('queued_on')
+            .values_list('id', 'student_id', 'category_id')[:batch_size]
         )
 
-        # Check if a delta exists for this set
-        if last_missing_delta_for_student:
-            old_set = set(
-                last_missing_delta_for_student
-                .missingassignmentrecord_set
-                .values_list('assignment_id', flat=True)
-            )
-            new_set = set([ma["assignment_id"] for ma in missing_assignments])
+        if not queued:
+            return 0, 0
 
-            if old_set == new_set:
-                continue
+        materialize_category_context_records(
+            list({category_id for _, _, category_id in queued}))
 
-        try:
-            clarify_gradebook = Gradebook.objects.get(
-                id=missing_assignments[0]['gradebook_id']
-            )
-            new_delta = Delta.objects.create(
-                type="missing",
-                student_id=student_id,
-                gradebook_id=clarify_gradebook.id,
-            )
+        for _, student_id, category_id in queued:
+            new_deltas += \
+                build_deltas_for_student_and_category(student_id, category_id)
 
-        except IntegrityError as e:
-            print(f"Error creating delta: {e}")
-            errors += 1
-            continue
-        except Exception as e:
-            import pdb
-            pdb.set_trace()
-            raise e
+        QueuedCategoryDelta.objects\
+            .filter(id__in=[queue_id for queue_id, _, _ in queued])\
+            .delete()
 
-        for assignment in missing_assignments:
-            clarify_assignment = Assignment.objects.get(
-                id=assignment["assignment_id"]
-            )
+    if new_deltas:
+        # Only the owners of the touched gradebooks see these deltas
+        bump_api_cache_generation(set(
+            Gradebook.owners.through.objects
+                .filter(gradebook__category__id__in=list(
+                    {category_id for _, _, category_id in queued}))
+                .values_list('userprofile_id', flat=True)
+        ))
 
-            try:
-                MissingAssignmentRecord.objects.create(
-                    delta=new_delta,
-                    assignment_id=clarify_assignment.id,
-                    missing_on=timezone.now().date()
-                )
-            except IntegrityError:
-                print(f"Error adding to delta: {e}")
-                errors += 1
+    return len(queued), new_deltas
 
-        new_deltas_created += 1
 
-    return new_deltas_created, errors
+def get_current_gradebook_ids_for_staff_ids(staff_ids):
+    """Deduplicated clarify gradebook ids owned by Illuminate staff ids"""
+    # staff_ids may be a mirror queryset; it can't be a subquery here
+    return list(
+        Gradebook.objects
+        .filter(owners__sis_id__in=list(staff_ids))
+        .distinct()
+        .values_list('id', flat=True)
+    )
 
 
-def build_deltas_for_all_current_academic_teachers(clean=False):
+def build_all_deltas_for_gradebook(gradebook_id):
+    """
+    Missing assignment and category deltas for one gradebook; the unit
+    of work for build_deltas_for_all_current_academic_teachers.
+    :return: new missing deltas, errors, new category deltas
+    """
+    new_missing_deltas, errors = \
+        build_missing_assignment_deltas_for_gradebook(gradebook_id)
+    new_category_deltas = build_deltas_for_gradebook(gradebook_id)
+
+    return new_missing_deltas, errors, new_category_deltas
+
+
+def build_deltas_for_all_current_academic_teachers(clean=False, workers=1):
 
     if clean:
         Delta.objects.all().delete()
+        CategoryRunningTotal.objects.all().delete()
 
     teacher_ids = Users.get_all_current_staff_ids()
+    gradebook_ids = get_current_gradebook_ids_for_staff_ids(teacher_ids)
 
     start = timezone.now()
 
+    # Class-wide context for every category up front, so delta
+    # building only has to look records up
+    context_records = materialize_category_context_records()
+
     missing_deltas = 0
     category_deltas = 0
     total_errors = 0
 
-    for teacher_id in tqdm(teacher_ids, desc="Staff"):
-        new_missing_deltas, errors = build_missing_assignment_deltas_for_user(
-            teacher_id)
-        new_category_deltas = build_deltas_for_staff_current_gradebooks(
-            teacher_id)
+    # Each gradebook is built by exactly one worker, so workers never
+    # contend over the same Delta or CategoryGradeContextRecord rows
+    if workers > 1:
+        results = imap_with_process_pool(
+            build_all_deltas_for_gradebook, gradebook_ids, workers)
+    else:
+        results = map(build_all_deltas_for_gradebook, gradebook_ids)
 
+    for new_missing_deltas, errors, new_category_deltas in tqdm(
+            results, desc="Gradebooks", total=len(gradebook_ids)):
         missing_deltas += new_missing_deltas
         category_deltas += new_category_deltas
         total_errors += errors
@@ -481,10 +963,12 @@ def build_deltas_for_all_current_academic_teachers(clean=False):
 
     success_string = "Completed all missing assignment and category " + \
         "deltas for current teachers." + \
-        f"\n\tTeachers: {len(teacher_ids)}" + \
+        f"\n\tTeachers: {len(teacher_ids)} | " + \
+        f"Gradebooks: {len(gradebook_ids)}" + \
         f"\n\tTotal new deltas: {total_new_deltas} | " + \
         f"Missing: {missing_deltas} | " + \
         f"Category: {category_deltas}" + \
+        f"\n\tNew context records: {context_records}" + \
         f"\n\tTotal errors: {total_errors}" + \
         f"\n\tTotal time elapsed: {minutes} min {seconds} sec"
 
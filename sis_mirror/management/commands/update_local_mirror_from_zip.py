@@ -1,10 +1,14 @@
 import os
 import re
+import json
 import zipfile
-import tempfile
-import glob
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from fnmatch import fnmatch
 from subprocess import call
 
+import psycopg2
+from psycopg2 import sql
+
 from django.core.management.base import BaseCommand
 
 
@@ -35,6 +39,33 @@ class Command(BaseCommand):
         parser.add_argument('--exclude-tables',
                             nargs="*")
 
+        load_mode = parser.add_mutually_exclusive_group()
+
+        load_mode.add_argument('--swap',
+                               action='store_true',
+                               dest='swap',
+                               help="Load each table into a staging copy and "
+                                    "swap it in, instead of deleting and "
+                                    "copying in place")
+
+        load_mode.add_argument('--diff',
+                               action='store_true',
+                               dest='diff',
+                               help="Apply only the rows that were inserted, "
+                                    "updated or deleted since the current "
+                                    "mirror contents")
+
+        parser.add_argument('--changes-file',
+                            dest="changesfile",
+                            help="With --diff, write per-table change "
+                                 "counts to this JSON file")
+
+        parser.add_argument('--jobs',
+                            dest="jobs",
+                            type=int,
+                            default=4,
+                            help="Number of tables to load concurrently")
+
     def handle(self, *args, **options):
         zipfile_name = options["zipfile"]
         schemafile_name = options["schemafile"]
@@ -42,13 +73,23 @@ class Command(BaseCommand):
         clearfirst = options["clearfirst"]
         tables=options["tables"]
         exclude_tables=options["exclude_tables"]
+        jobs = options["jobs"]
+        swap = options["swap"]
+        diff = options["diff"]
+        changesfile_name = options["changesfile"]
 
         if schemafile_name:
             self._update_schema(schemafile_name, localdb)
 
         if zipfile_name:
-            self._update_mirror(zipfile_name, localdb, clearfirst=clearfirst,
-                                tables=tables, exclude_tables=exclude_tables)
+            changes = self._update_mirror(
+                zipfile_name, localdb, clearfirst=clearfirst, tables=tables,
+                exclude_tables=exclude_tables, jobs=jobs, swap=swap, diff=diff
+            )
+
+            if changesfile_name:
+                with open(changesfile_name, 'w') as outfile:
+                    json.dump(changes, outfile, indent=2, sort_keys=True)
 
         self.stdout.write(self.style.SUCCESS(
             f"Completed update{' with schema' if schemafile_name else ''}."
@@ -64,66 +105,381 @@ class Command(BaseCommand):
         return call(args)
 
     def _update_mirror(self, zipfile_name, localdb, clearfirst=False,
-                       tables=None, exclude_tables=None):
-        # Starting point for copying from a zip of dump files
+                       tables=None, exclude_tables=None, jobs=1,
+                       swap=False, diff=False):
+        # Each dump is streamed straight out of the zip into COPY; tables
+        # are independent, so they load concurrently, each worker with
+        # its own connection and its own handle on the zip
+        with zipfile.ZipFile(zipfile_name, 'r') as zip_ref:
+            member_names = [
+                name for name in zip_ref.namelist()
+                if fnmatch(os.path.basename(name), 'clean_*.pgsql')
+            ]
 
-        zip_ref = zipfile.ZipFile(zipfile_name, 'r')
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = [
+                executor.submit(self._update_table_from_zip,
+                                zipfile_name, member_name, localdb,
+                                clearfirst, tables, exclude_tables, swap,
+                                diff)
+                for member_name in member_names
+            ]
 
-        with tempfile.TemporaryDirectory() as tmpdirname:
-            zip_ref.extractall(tmpdirname)
+            # { <table_name>: { inserted, updated, deleted } } with --diff
+            changes = {}
 
-            # go through each file and process and update
-            for filepath in glob.iglob(tmpdirname + '/clean_*.pgsql'):
-                exit_code, table_name = self\
-                    ._update_table_with_file(
-                    filepath, localdb, clearfirst, tables, exclude_tables
-                )
-                
-                if exit_code is not 0:
-                    raise RuntimeError(f'Error updating {filepath}.')
-                
-                if table_name is not "SKIPPED":
+            for future in as_completed(futures):
+                table_name, table_changes = future.result()
+
+                if table_name == "SKIPPED":
+                    continue
+
+                if table_changes is not None:
+                    changes[table_name] = table_changes
+                    print(f"\tTable {table_name} refreshed: " +
+                          ", ".join(f"{count} {change}"
+                                    for change, count
+                                    in table_changes.items()))
+                else:
                     print(f"\tTable {table_name} refreshed.")
 
-    def _update_table_with_file(self, filepath, localdb, clearfirst=False,
-                                tables=None, exclude_tables=None):
+        return changes
+
+    def _update_table_from_zip(self, zipfile_name, member_name, localdb,
+                               clearfirst=False, tables=None,
+                               exclude_tables=None, swap=False, diff=False):
         # turn filename into sis table
         # EX: clean_2019-01-20--18-22_selectall_assignment_gsca_aff.pgsql
-        filename = os.path.basename(filepath)
+        filename = os.path.basename(member_name)
         table_name = self.filename_to_tablename(filename)
         if (exclude_tables and table_name in exclude_tables) or (
                 tables and table_name not in tables):
-            return 0, "SKIPPED"
-        
-        # clear the table if clearfirst
-        if clearfirst:
-            cleared = self._drop_all_from_table(table_name, localdb)
-            if cleared is not 0:
-                raise RuntimeError(f'Error deleting table "{table_name}".')
-            print(f"\tDeleted all rows from {table_name}")
-
-        # copy command with psql
-        copy_command = \
-            '\copy {} from \'{}\' csv delimiter \'{}\' null as \'NULL\'' \
-                .format(table_name, filepath, self.DELIMITER)
-        args = ['psql',
-                '-d', localdb,
-                '-c', copy_command
-                ]
-
-        return call(args), table_name
+            return "SKIPPED", None
+
+        table_changes = None
+        connection = psycopg2.connect(dbname=localdb)
+
+        try:
+            # One transaction: readers keep seeing the old rows
+            # until the new ones are committed
+            with connection, connection.cursor() as cursor, \
+                    zipfile.ZipFile(zipfile_name, 'r') as zip_ref, \
+                    zip_ref.open(member_name) as dump_file:
+
+                if swap and self._is_referenced(cursor, table_name):
+                    # The old table can't be dropped out from under the
+                    # foreign keys and views that depend on it
+                    print(f"\t{table_name} is referenced by foreign keys "
+                          f"or views; reloading in place")
+                    swap, clearfirst = False, True
+
+                if diff:
+                    table_changes = self._copy_and_diff_table(
+                        cursor, table_name, dump_file)
+                elif swap:
+                    self._copy_and_swap_table(cursor, table_name, dump_file)
+                    print(f"\tSwapped in new {table_name}")
+                else:
+                    # clear the table if clearfirst
+                    if clearfirst:
+                        self._drop_all_from_table(cursor, table_name)
+                        print(f"\tDeleted all rows from {table_name}")
+
+                    self._copy_into_table(cursor, sql.Identifier(table_name),
+                                          dump_file)
+        except psycopg2.Error as e:
+            raise RuntimeError(f'Error updating {filename}: {e}')
+        finally:
+            connection.close()
+
+        return table_name, table_changes
+
+    def _copy_into_table(self, cursor, table_identifier, dump_file):
+        cursor.copy_expert(
+            sql.SQL(
+                "COPY {} FROM STDIN WITH "
+                "(FORMAT csv, DELIMITER {}, NULL 'NULL')"
+            ).format(table_identifier,
+                     sql.Literal(self.DELIMITER)).as_string(cursor),
+            dump_file
+        )
+
+    def _copy_and_diff_table(self, cursor, table_name, dump_file):
+        """
+        COPY the dump into a temp table and apply only the difference to
+        the mirror table: rows are matched on primary key and compared
+        by md5 of their text form. Tables without a primary key can't be
+        matched and are reloaded in full.
+        :return: { inserted, updated, deleted } row counts
+        """
+        cursor.execute(
+            """
+            SELECT a.attname
+            FROM pg_index x
+            JOIN pg_attribute a ON a.attrelid = x.indrelid
+                               AND a.attnum = ANY(x.indkey)
+            WHERE x.indrelid = %s::regclass AND x.indisprimary
+            """,
+            [table_name]
+        )
+        key_columns = [row[0] for row in cursor.fetchall()]
+
+        table = sql.Identifier(table_name)
+
+        if not key_columns:
+            self._drop_all_from_table(cursor, table_name)
+            deleted = cursor.rowcount
+            self._copy_into_table(cursor, table, dump_file)
+            return {"inserted": cursor.rowcount, "updated": 0,
+                    "deleted": deleted}
+
+        staging = sql.Identifier(f"{table_name[:55]}_staging")
+
+        cursor.execute(
+            sql.SQL(
+                "CREATE TEMP TABLE {} (LIKE {} INCLUDING DEFAULTS) "
+                "ON COMMIT DROP"
+            ).format(staging, table)
+        )
+        self._copy_into_table(cursor, staging, dump_file)
+        cursor.execute(sql.SQL("ANALYZE {}").format(staging))
+
+        key_match = sql.SQL(" AND ").join(
+            sql.SQL("t.{0} = s.{0}").format(sql.Identifier(column))
+            for column in key_columns
+        )
+
+        cursor.execute(
+            sql.SQL(
+                "DELETE FROM {} t WHERE NOT EXISTS "
+                "(SELECT 1 FROM {} s WHERE {})"
+            ).format(table, staging, key_match)
+        )
+        deleted = cursor.rowcount
+
+        cursor.execute(
+            """
+            SELECT attname FROM pg_attribute
+            WHERE attrelid = %s::regclass AND attnum > 0
+              AND NOT attisdropped
+            ORDER BY attnum
+            """,
+            [table_name]
+        )
+        value_columns = [row[0] for row in cursor.fetchall()
+                         if row[0] not in key_columns]
+
+        updated = 0
+        if value_columns:
+            cursor.execute(
+                sql.SQL(
+                    "UPDATE {} t SET {} FROM {} s "
+                    "WHERE {} AND md5(t::text) <> md5(s::text)"
+                ).format(
+                    table,
+                    sql.SQL(", ").join(
+                        sql.SQL("{0} = s.{0}").format(sql.Identifier(column))
+                        for column in value_columns
+                    ),
+                    staging,
+                    key_match
+                )
+            )
+            updated = cursor.rowcount
+
+        cursor.execute(
+            sql.SQL(
+                "INSERT INTO {} SELECT s.* FROM {} s WHERE NOT EXISTS "
+                "(SELECT 1 FROM {} t WHERE {})"
+            ).format(table, staging, table, key_match)
+        )
+        inserted = cursor.rowcount
+
+        return {"inserted": inserted, "updated": updated, "deleted": deleted}
+
+    def _copy_and_swap_table(self, cursor, table_name, dump_file):
+        """
+        COPY into an unindexed <table>_new, build its constraints and
+        indexes, ANALYZE it, then drop the old table and rename the new
+        one into place. Runs inside the caller's transaction, so readers
+        see the old table until commit and only wait on the final swap.
+        The old table's owner and grants are carried over; tables with
+        dependent views are never swapped (see _is_referenced).
+        """
+        cursor.execute(
+            """
+            SELECT n.nspname, c.oid, pg_get_userbyid(c.relowner)
+            FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+            WHERE c.oid = %s::regclass
+            """,
+            [table_name]
+        )
+        schema, table_oid, owner = cursor.fetchone()
+
+        table = self._qualified(schema, table_name)
+        new_name = f"{table_name[:59]}_new"
+        new_table = self._qualified(schema, new_name)
+
+        def _temp_name(i):
+            return f"{table_name[:50]}_swap_{i}"
+
+        cursor.execute(
+            sql.SQL("DROP TABLE IF EXISTS {}").format(new_table))
+        cursor.execute(
+            sql.SQL(
+                "CREATE TABLE {} (LIKE {} INCLUDING DEFAULTS "
+                "INCLUDING CONSTRAINTS INCLUDING STORAGE INCLUDING COMMENTS)"
+            ).format(new_table, table)
+        )
+
+        self._copy_into_table(cursor, new_table, dump_file)
+
+        # LIKE doesn't copy ownership or privileges
+        cursor.execute(
+            sql.SQL("ALTER TABLE {} OWNER TO {}").format(
+                new_table, sql.Identifier(owner))
+        )
+        cursor.execute(
+            """
+            SELECT CASE WHEN a.grantee = 0 THEN NULL
+                        ELSE pg_get_userbyid(a.grantee) END,
+                   a.privilege_type, a.is_grantable
+            FROM pg_class c, aclexplode(c.relacl) a
+            WHERE c.oid = %s
+            """,
+            [table_oid]
+        )
+        for grantee, privilege, is_grantable in cursor.fetchall():
+            cursor.execute(
+                sql.SQL(f"GRANT {privilege} ON {{}} TO {{}}"
+                        f"{' WITH GRANT OPTION' if is_grantable else ''}"
+                        ).format(
+                    new_table,
+                    sql.Identifier(grantee) if grantee else sql.SQL("PUBLIC")
+                )
+            )
+
+        # Check constraints came across with LIKE; keys and indexes are
+        # built after the load, under temporary names until the swap
+        renames = []
+
+        cursor.execute(
+            """
+            SELECT conname, pg_get_constraintdef(oid)
+            FROM pg_constraint
+            WHERE conrelid = %s AND contype IN ('p', 'u', 'x', 'f')
+            ORDER BY contype DESC
+            """,
+            [table_oid]
+        )
+        for conname, definition in cursor.fetchall():
+            temp_name = _temp_name(len(renames))
+            cursor.execute(
+                sql.SQL("ALTER TABLE {} ADD CONSTRAINT {} ").format(
+                    new_table, sql.Identifier(temp_name)
+                ) + sql.SQL(definition)
+            )
+            renames.append(
+                sql.SQL("ALTER TABLE {} RENAME CONSTRAINT {} TO {}").format(
+                    table, sql.Identifier(temp_name), sql.Identifier(conname)
+                )
+            )
+
+        cursor.execute(
+            """
+            SELECT i.relname, pg_get_indexdef(i.oid)
+            FROM pg_index x JOIN pg_class i ON i.oid = x.indexrelid
+            WHERE x.indrelid = %s
+              AND NOT EXISTS (SELECT 1 FROM pg_constraint c
+                              WHERE c.conrelid = x.indrelid
+                                AND c.conindid = x.indexrelid)
+            """,
+            [table_oid]
+        )
+        for index_name, definition in cursor.fetchall():
+            temp_name = _temp_name(len(renames))
+            using = re.search(r" USING .*$", definition).group(0)
+            unique = "UNIQUE " if definition.startswith("CREATE UNIQUE") \
+                else ""
+            cursor.execute(
+                sql.SQL(f"CREATE {unique}INDEX {{}} ON {{}}").format(
+                    sql.Identifier(temp_name), new_table
+                ) + sql.SQL(using)
+            )
+            renames.append(
+                sql.SQL("ALTER INDEX {} RENAME TO {}").format(
+                    self._qualified(schema, temp_name),
+                    sql.Identifier(index_name)
+                )
+            )
+
+        cursor.execute(sql.SQL("ANALYZE {}").format(new_table))
+
+        # Serial columns' sequences are owned by the old table and
+        # would be dropped with it
+        cursor.execute(
+            """
+            SELECT s.relname, a.attname
+            FROM pg_depend d
+            JOIN pg_class s ON s.oid = d.objid AND s.relkind = 'S'
+            JOIN pg_namespace n ON n.oid = s.relnamespace
+            JOIN pg_attribute a ON a.attrelid = d.refobjid
+                               AND a.attnum = d.refobjsubid
+            WHERE d.refobjid = %s AND d.deptype = 'a'
+            """,
+            [table_oid]
+        )
+        for sequence_name, column_name in cursor.fetchall():
+            cursor.execute(
+                sql.SQL("ALTER SEQUENCE {} OWNED BY {}").format(
+                    self._qualified(schema, sequence_name),
+                    self._qualified(schema, new_name, column_name)
+                )
+            )
+
+        cursor.execute(sql.SQL("DROP TABLE {}").format(table))
+        cursor.execute(
+            sql.SQL("ALTER TABLE {} RENAME TO {}").format(
+                new_table, sql.Identifier(table_name)
+            )
+        )
+
+        for rename in renames:
+            cursor.execute(rename)
 
     @staticmethod
-    def _drop_all_from_table(table_name, dbname):
-        drop_command = f"delete from {table_name};"
+    def _qualified(schema, *names):
+        return sql.SQL('.').join(
+            sql.Identifier(name) for name in (schema,) + names
+        )
 
-        args = [
-            'psql',
-            '-d', dbname,
-            '-c', drop_command
-        ]
+    @staticmethod
+    def _is_referenced(cursor, table_name):
+        """
+        Whether table_name has foreign keys pointing at it, or views or
+        materialized views (whose rewrite rules depend on it) built on it
+        """
+        cursor.execute(
+            """
+            SELECT EXISTS (SELECT 1 FROM pg_constraint
+                           WHERE confrelid = %s::regclass
+                             AND contype = 'f')
+                OR EXISTS (SELECT 1
+                           FROM pg_depend d
+                           JOIN pg_rewrite r ON r.oid = d.objid
+                           WHERE d.classid = 'pg_rewrite'::regclass
+                             AND d.refobjid = %s::regclass
+                             AND r.ev_class <> d.refobjid)
+            """,
+            [table_name, table_name]
+        )
+        return cursor.fetchone()[0]
 
-        return call(args)
+    @staticmethod
+    def _drop_all_from_table(cursor, table_name):
+        cursor.execute(
+            sql.SQL("delete from {};").format(sql.Identifier(table_name))
+        )
 
     @staticmethod
     def filename_to_tablename(filename):
@@ -27,7 +27,7 @@ Order of loading:
 from __future__ import unicode_literals
 
 from django.db import models
-from django.db.models import F, Q
+from django.db.models import F, Q, Max
 from django.utils import timezone
 from django.conf import settings
 
@@ -171,7 +171,7 @@ class Students(models.Model):
         return self.last_name + ", " + self.first_name
 
     @staticmethod
-    def get_current_students_for_staff_id(staff_id):
+    def get_current_students_for_staff_id(staff_id=None):
         return SsCube.get_current_students_for_staff_id(staff_id)
 
     @staticmethod
@@ -326,7 +326,7 @@ class Sites(models.Model):
         return self.site_name
 
     @staticmethod
-    def get_current_sites_for_staff_id(user_id):
+    def get_current_sites_for_staff_id(user_id=None):
         return UserTermRoleAff.get_current_sites_for_user_id(user_id)
 
     class Meta:
@@ -387,12 +387,12 @@ class Sections(models.Model):
         return self.section_name or str(self.section_id)
 
     @staticmethod
-    def get_current_sections_for_staff_id(staff_id):
+    def get_current_sections_for_staff_id(staff_id=None):
         return SectionTeacherAffDates\
             .get_current_sections_for_staff_id(staff_id)
 
     @staticmethod
-    def get_current_staff_section_records_for_staff_id(staff_id):
+    def get_current_staff_section_records_for_staff_id(staff_id=None):
         return SectionTeacherAffDates\
             .get_current_staff_section_records_for_staff_id(staff_id)
 
@@ -574,7 +574,7 @@ class SectionStudentAff(models.Model):
         db_table = 'section_student_aff'
 
     @classmethod
-    def get_current_enrollment_for_staff_id(cls, staff_id):
+    def get_current_enrollment_for_staff_id(cls, staff_id=None):
         section_ids = (Sections
             .get_current_sections_for_staff_id(staff_id)
             .values('section_id'))
@@ -594,9 +594,13 @@ class SectionStudentAff(models.Model):
 
 
 class TeacherSectionsMixin:
+    """
+    Current section lookups; a staff_id of None returns
+    the current sections for every staff member.
+    """
 
     @classmethod
-    def get_current_sections_for_staff_id(cls, staff_id):
+    def get_current_sections_for_staff_id(cls, staff_id=None):
         grading_period_string = "__".join([
             "section", "sectiongradingperiodaff", "grading_period"
         ])
@@ -631,11 +635,13 @@ class TeacherSectionsMixin:
 
         now = timezone.now()
 
+        staff_filter = {} if staff_id is None else {'user_id': staff_id}
+
         return (cls.objects
             .filter(
-                user_id=staff_id,
                 start_date__lte=now,
-                end_date__gte=now
+                end_date__gte=now,
+                **staff_filter
             )
             .annotate(
                 name=F('section__section_name'),
@@ -653,12 +659,24 @@ class TeacherSectionsMixin:
         ))
 
     @classmethod
-    def get_current_staff_section_records_for_staff_id(cls, staff_id):
+    def get_current_staff_section_records_for_staff_id(cls, staff_id=None):
         return (cls.get_current_sections_for_staff_id(staff_id)
                 .annotate(sis_section_id=F('section_id'))
+                .order_by('section_id', 'user_id')
+                .distinct('section_id', 'user_id')
                 .values('sis_user_id', 'sis_section_id', 'primary_teacher',
                         'start_date', 'end_date'))
 
+    @classmethod
+    def get_current_section_staff_ids(cls):
+        """Return (section_id, user_id) for every current teacher"""
+        now = timezone.now()
+
+        return (cls.objects
+                .filter(start_date__lte=now, end_date__gte=now)
+                .distinct()
+                .values_list('section_id', 'user_id'))
+
 
 class SectionTeacherAff(TeacherSectionsMixin, models.Model):
     sta_id = models.IntegerField(primary_key=True)
@@ -794,7 +812,7 @@ class Terms(models.Model):
     local_term_id = models.IntegerField(blank=True, null=True)
 
     @staticmethod
-    def get_current_terms_for_staff_id(user_id):
+    def get_current_terms_for_staff_id(user_id=None):
         return UserTermRoleAff.get_current_terms_for_user_id(user_id)
 
     class Meta:
@@ -815,11 +833,14 @@ class UserTermRoleAff(models.Model):
     last_schedule_id = models.IntegerField(blank=True, null=True)
 
     @classmethod
-    def get_current_rows_for_user(cls, user_id):
+    def get_current_rows_for_user(cls, user_id=None):
+        """Current rows for user_id, or for every user if None"""
+        user_filter = {} if user_id is None else {'user_id': user_id}
+
         return cls.objects.filter(
-            user_id=user_id,
             term__start_date__lte=timezone.now(),
             term__end_date__gte=timezone.now(),
+            **user_filter
         )
 
     @classmethod
@@ -844,16 +865,17 @@ class UserTermRoleAff(models.Model):
         return [_shape(r) for r in current_roles]
 
     @classmethod
-    def get_current_sites_for_user_id(cls, user_id):
+    def get_current_sites_for_user_id(cls, user_id=None):
         return (cls.get_current_rows_for_user(user_id)
                 .annotate(sis_id=F('term__session__site_id'),
                           name=F('term__session__site__site_name'),
                           )
                 .values('sis_id', 'name')
+                .distinct()
                 )
 
     @classmethod
-    def get_current_terms_for_user_id(cls, user_id):
+    def get_current_terms_for_user_id(cls, user_id=None):
         return (cls.get_current_rows_for_user(user_id)
                 .annotate(sis_id=F('term_id'),
                           start_date=F('term__start_date'),
@@ -863,7 +885,8 @@ class UserTermRoleAff(models.Model):
                           academic_year=F('term__session__academic_year')
                           )
                 ).values('sis_id', 'name', 'start_date',
-                         'end_date', 'sis_site_id', 'academic_year')
+                         'end_date', 'sis_site_id', 'academic_year'
+                         ).distinct()
 
     @classmethod
     def get_all_current_staff_ids(cls):
@@ -1020,13 +1043,15 @@ class SsCube(models.Model):
         db_table = with_schema(MATVIEWS_SCHEMA, 'ss_cube')
 
     @classmethod
-    def get_current_students_for_staff_id(cls, staff_id):
+    def get_current_students_for_staff_id(cls, staff_id=None):
         section_ids = (Sections.get_current_sections_for_staff_id(staff_id)
                                .values('section_id'))
 
+        staff_filter = {} if staff_id is None else {'user_id': staff_id}
+
         return (cls.objects
                     .filter(section_id__in=section_ids,
-                           user_id=staff_id)
+                            **staff_filter)
                     .annotate(
                         sis_id=F('student_id'),
                         first_name=F('student__first_name'),
@@ -1075,7 +1100,7 @@ class Categories(models.Model):
         db_table = with_schema('gradebook', 'categories')
 
     @classmethod
-    def get_current_categories_for_staff_id(cls, staff_id):
+    def get_current_categories_for_staff_id(cls, staff_id=None):
         gradebook_ids = (Gradebooks
             .get_current_gradebooks_for_staff_id(staff_id)
             .values('gradebook_id'))
@@ -1110,7 +1135,7 @@ class Gradebooks(models.Model):
         return self.gradebook_name or str(self.gradebook_id)
 
     @staticmethod
-    def get_current_gradebooks_for_staff_id(staff_id):
+    def get_current_gradebooks_for_staff_id(staff_id=None):
         """Convenience method"""
         return GradebookSectionCourseAff\
             .get_current_gradebooks_for_staff_id(staff_id)
@@ -1155,7 +1180,7 @@ class GradebookSectionCourseAff(models.Model):
         return cls.objects.filter(**gsca_filter)
 
     @classmethod
-    def get_current_gradebooks_for_staff_id(cls, staff_id):
+    def get_current_gradebooks_for_staff_id(cls, staff_id=None):
 
         current_sections_for_staff_id = (
             Sections
@@ -1178,6 +1203,30 @@ class GradebookSectionCourseAff(models.Model):
                         'sis_user_id', 'sis_section_id')
         )
 
+    @classmethod
+    def get_current_gradebook_owners(cls):
+        """
+        Return { sis_gradebook_id, sis_user_id } for every current
+        teacher of a section attached to a current gradebook
+        """
+        section_staff = {}
+        for section_id, user_id in \
+                SectionTeacherAffDates.get_current_section_staff_ids():
+            section_staff.setdefault(section_id, set()).add(user_id)
+
+        gradebook_sections = (
+            cls.objects
+                .filter(section_id__in=list(section_staff))
+                .distinct()
+                .values_list('gradebook_id', 'section_id')
+        )
+
+        return [
+            {'sis_gradebook_id': gradebook_id, 'sis_user_id': user_id}
+            for gradebook_id, section_id in gradebook_sections
+            for user_id in section_staff[section_id]
+        ]
+
     class Meta:
         managed = False
         db_table = with_schema(GRADEBOOK_SCHEMA, 'gradebook_section_course_aff')
@@ -1239,7 +1288,7 @@ class Assignments(models.Model):
         db_table = with_schema(GRADEBOOK_SCHEMA, 'assignments')
 
     @classmethod
-    def get_current_assignments_for_staff_id(cls, staff_id):
+    def get_current_assignments_for_staff_id(cls, staff_id=None):
         gradebook_ids = (Gradebooks
                          .get_current_gradebooks_for_staff_id(staff_id)
                          .values('gradebook_id'))
@@ -1252,7 +1301,7 @@ class Assignments(models.Model):
                           sis_category_id=F('category_id'))
                 .values('sis_id', 'name', 'due_date',
                         'sis_gradebook_id', 'sis_category_id',
-                        'possible_points', 'is_active'))
+                        'possible_points', 'possible_score', 'is_active'))
 
 
 class AssignmentGscaAff(models.Model):
@@ -1319,22 +1368,53 @@ class ScoreCache(models.Model):
                 .all())
 
     @classmethod
-    def get_current_scores_for_staff_id(cls, staff_id):
+    def get_current_scores_for_staff_id(cls, staff_id=None,
+                                        updated_since=None):
+        """
+        :param updated_since: optional { gradebook_id: datetime }; scores
+            in those gradebooks are only returned if updated after the
+            given time (or never stamped). Other gradebooks return all.
+        :return: lazy values() queryset; large pulls should be
+            consumed with .iterator() rather than evaluated whole
+        """
         gradebook_ids = (Gradebooks
                          .get_current_gradebooks_for_staff_id(staff_id)
                          .values('gradebook_id'))
 
-        return (cls.objects
-                .filter(gradebook_id__in=gradebook_ids)
+        scores = cls.objects.filter(gradebook_id__in=gradebook_ids)
+
+        if updated_since:
+            gradebook_ids_by_mark = {}
+            for gradebook_id, mark in updated_since.items():
+                gradebook_ids_by_mark.setdefault(mark, []).append(gradebook_id)
+
+            updated_q = ~Q(gradebook_id__in=list(updated_since.keys()))
+            for mark, mark_gradebook_ids in gradebook_ids_by_mark.items():
+                updated_q |= (
+                    Q(gradebook_id__in=mark_gradebook_ids) &
+                    (Q(last_updated__gt=mark) | Q(last_updated__isnull=True))
+                )
+
+            scores = scores.filter(updated_q)
+
+        return (scores
                 .exclude(is_excused=False,
                          points__isnull=True)
                 .annotate(sis_id=F('cache_id'),
                           sis_student_id=F('student_id'),
                           sis_assignment_id=F('assignment_id'),
+                          sis_gradebook_id=F('gradebook_id'),
                           )
                 .values('sis_id', 'sis_student_id', 'sis_assignment_id',
-                        'score', 'points', 'is_missing', 'is_excused',
-                        'last_updated'))
+                        'sis_gradebook_id', 'score', 'points', 'percentage',
+                        'is_missing', 'is_excused', 'last_updated'))
+
+    @classmethod
+    def get_last_updated_for_gradebook_ids(cls, gradebook_ids):
+        return (cls.objects
+                .filter(gradebook_id__in=gradebook_ids)
+                .aggregate(last_updated=Max('last_updated'))
+                .get('last_updated'))
 
     def __str__(self):
         return f"S:{self.student_id}, " \